@@ -0,0 +1,363 @@
+import os
+import sys
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+from collections import Counter, deque
+from datetime import datetime
+from types import SimpleNamespace
+
+# Бенчмарк работает без сети: main.py нужны только заглушки ключей, Supabase и Telegram подменяются ниже
+os.environ.setdefault('BOT_TOKEN', '123456:BENCHMARK')
+os.environ.setdefault('SUPABASE_URL', 'https://benchmark.invalid')
+os.environ.setdefault('SUPABASE_KEY', 'benchmark')
+os.environ.setdefault('BROADCAST_DB_PATH', os.path.join(tempfile.mkdtemp(prefix='bench-'), 'broadcasts.sqlite3'))
+
+# Сценарий startup замеряет импорт main.py, поэтому он импортируется раньше, чем telegram для заглушек
+_import_started_at = time.perf_counter()
+import main
+MAIN_IMPORT_SECONDS = time.perf_counter() - _import_started_at
+
+from telegram import Chat, Message, Update, User
+from telegram.error import RetryAfter
+
+# --- БЛОК 1: ЗАГЛУШКА SUPABASE С ЗАДАВАЕМОЙ ЗАДЕРЖКОЙ ---
+class StubResponse:
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+class StubQuery:
+    def __init__(self, db, table):
+        self.db = db
+        self.table = table
+        self.operation = 'select'
+        self.columns = None
+        self.filters = []
+        self.count = None
+        self.head = False
+        self.bounds = None
+        self.payload = None
+        self.on_conflict = None
+
+    def select(self, columns='*', count=None, head=None):
+        self.columns = None if columns.strip() == '*' else [column.strip() for column in columns.split(',')]
+        self.count = count
+        self.head = bool(head)
+        return self
+
+    def eq(self, column, value):
+        self.filters.append(lambda row: row.get(column) == value)
+        return self
+
+    def in_(self, column, values):
+        values = set(values)
+        self.filters.append(lambda row: row.get(column) in values)
+        return self
+
+    def order(self, *args, **kwargs):
+        return self
+
+    def limit(self, size):
+        self.bounds = (0, size - 1)
+        return self
+
+    def range(self, start, end):
+        self.bounds = (start, end)
+        return self
+
+    def insert(self, rows):
+        self.operation, self.payload = 'insert', rows
+        return self
+
+    def upsert(self, rows, on_conflict=None, **kwargs):
+        self.operation, self.payload, self.on_conflict = 'upsert', rows, on_conflict
+        return self
+
+    def update(self, values):
+        self.operation, self.payload = 'update', values
+        return self
+
+    def delete(self):
+        self.operation = 'delete'
+        return self
+
+    async def execute(self):
+        await self.db.delay()
+        self.db.calls[self.table] += 1
+        rows = self.db.tables.setdefault(self.table, [])
+        if self.operation == 'insert':
+            return StubResponse(self.db.insert(self.table, self.payload, upsert=False))
+        if self.operation == 'upsert':
+            return StubResponse(self.db.insert(self.table, self.payload, upsert=True))
+        matched = [row for row in rows if all(check(row) for check in self.filters)]
+        if self.operation == 'update':
+            for row in matched:
+                row.update(self.payload)
+            return StubResponse(matched)
+        if self.operation == 'delete':
+            self.db.tables[self.table] = [row for row in rows if row not in matched]
+            return StubResponse(matched)
+        count = len(matched) if self.count else None
+        if self.head:
+            return StubResponse([], count)
+        if self.bounds:
+            matched = matched[self.bounds[0]:self.bounds[1] + 1]
+        if self.columns:
+            matched = [{column: row.get(column) for column in self.columns} for row in matched]
+        else:
+            matched = [dict(row) for row in matched]
+        return StubResponse(matched, count)
+
+class StubSupabase:
+    # Уникальные ключи таблиц, как в настоящей схеме: повторная вставка падает с ошибкой
+    UNIQUE_KEYS = {'users': main.USERS_TABLE_TG_ID_COLUMN}
+
+    def __init__(self, tables, latency, jitter):
+        self.tables = tables
+        self.latency = latency
+        self.jitter = jitter
+        self.calls = Counter()
+
+    async def delay(self):
+        await asyncio.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+
+    def table(self, name):
+        return StubQuery(self, name)
+
+    def insert(self, table, payload, upsert):
+        rows = self.tables.setdefault(table, [])
+        key = self.UNIQUE_KEYS.get(table)
+        inserted = []
+        for new_row in payload if isinstance(payload, list) else [payload]:
+            existing = next((row for row in rows if key and row.get(key) == new_row.get(key)), None)
+            if existing is not None:
+                if not upsert:
+                    raise Exception(f'duplicate key value violates unique constraint "{table}_{key}_key"')
+                existing.update(new_row)
+                inserted.append(existing)
+            else:
+                rows.append(dict(new_row))
+                inserted.append(new_row)
+        return inserted
+
+def build_tables(employees, registered_share):
+    cities = ["Москва", "Казань", "Самара", "Пермь", "Томск"]
+    persinfo, users, tmday, tmmonth = [], [], [], []
+    for index in range(employees):
+        username = 'admin' if index == 0 else f'op{index}'
+        persinfo.append({
+            main.PERSINFO_TABLE_TG_USERNAME_COLUMN: username,
+            main.PERSINFO_TABLE_FULL_NAME_COLUMN: f"Оператор Номер{index}",
+            main.PERSINFO_TABLE_CITY_COLUMN: cities[index % len(cities)],
+            main.PERSINFO_TABLE_TEAM_COLUMN: f"Команда{index % 20}",
+            main.PERSINFO_TABLE_DOLG_COLUMN: "Админ" if index == 0 else "Оператор",
+            main.PERSINFO_TABLE_PLAN_LID_COLUMN: 10,
+            main.PERSINFO_TABLE_RGTM_COLUMN: f"rgtm{index % 5}",
+            main.PERSINFO_TABLE_TEAMLEAD_COLUMN: f"lead{index % 20}",
+            main.PERSINFO_TABLE_URL_COLUMN: f"https://crm.example/{index % 20}",
+        })
+        if index == 0 or random.random() < registered_share:
+            users.append({main.USERS_TABLE_TG_ID_COLUMN: user_id(index), main.USERS_TABLE_TG_USERNAME_COLUMN: username})
+        tmday.append({main.TMDAY_TABLE_TG_USERNAME_COLUMN: username, main.TMDAY_TABLE_LID_COLUMN: index % 30, main.TMDAY_TABLE_TRAFIC_COLUMN: "02:15:00", main.TMDAY_TABLE_KZ_COLUMN: 250})
+        tmmonth.append({main.TMMONTH_TABLE_TG_USERNAME_COLUMN: username, main.TMMONTH_TABLE_COS_COLUMN: index % 3, main.TMMONTH_TABLE_MOLNII_COLUMN: index % 7})
+    return {'persinfo': persinfo, 'users': users, 'TMday': tmday, 'TMmonth': tmmonth}
+
+def user_id(index):
+    return 100000 + index
+
+def username_of(index):
+    return 'admin' if index == 0 else f'op{index}'
+
+# --- БЛОК 2: ФЕЙКОВЫЙ TELEGRAM С ЛИМИТАМИ ---
+class FakeBot:
+    def __init__(self, latency, global_rate, per_chat_interval, enforce_limits):
+        self.latency = latency
+        self.global_rate = global_rate
+        self.per_chat_interval = per_chat_interval
+        self.enforce_limits = enforce_limits
+        self.sent_times = deque()
+        self.last_sent_by_chat = {}
+        self.sent = 0
+        self.retry_after = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if self.enforce_limits:
+            # Как настоящий Bot API: превышение лимита сразу отвечает RetryAfter, сообщение не доставляется
+            now = time.monotonic()
+            while self.sent_times and now - self.sent_times[0] >= 1:
+                self.sent_times.popleft()
+            last_sent = self.last_sent_by_chat.get(chat_id)
+            if len(self.sent_times) >= self.global_rate or (last_sent is not None and now - last_sent < self.per_chat_interval):
+                self.retry_after += 1
+                raise RetryAfter(1)
+            self.sent_times.append(now)
+            self.last_sent_by_chat[chat_id] = now
+        await asyncio.sleep(self.latency)
+        self.sent += 1
+
+class FakeApplication:
+    def __init__(self, bot):
+        self.bot = bot
+
+def make_update(update_id, index, text, bot):
+    user = User(id=user_id(index), first_name=f"Оператор{index}", is_bot=False, username=username_of(index))
+    chat = Chat(id=user_id(index), type=Chat.PRIVATE)
+    message = Message(message_id=update_id, date=datetime.now(), chat=chat, from_user=user, text=text)
+    message.set_bot(bot)
+    return Update(update_id=update_id, message=message)
+
+def make_context(bot, application, args):
+    return SimpleNamespace(bot=bot, application=application, args=args)
+
+# --- БЛОК 3: СЦЕНАРИИ ---
+def percentile(samples, percent):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+async def reset_state(cold):
+    await main.profile_cache.invalidate()
+    main.profile_cache.hits = main.profile_cache.misses = 0
+    for snapshot in (main.tmday_snapshot, main.tmmonth_snapshot):
+        await snapshot.backend.clear()
+        snapshot.loaded_at, snapshot.hits, snapshot.misses = None, 0, 0
+    await main.stats_cache.clear()
+    main.directory.__init__()
+    if not cold:
+        # То же, что делают задачи JobQueue сразу после запуска бота
+        await asyncio.gather(main.directory.refresh(), main.tmday_snapshot.refresh(), main.tmmonth_snapshot.refresh())
+
+async def run_handler_scenario(command, handler, args, stub, bot):
+    await reset_state(args.cold)
+    calls_before = sum(stub.calls.values())
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+    application = FakeApplication(bot)
+
+    async def one_request(number):
+        index = 1 + number % (args.employees - 1)
+        async with semaphore:
+            update = make_update(number, index, f"/{command}", bot)
+            started_at = time.perf_counter()
+            await handler(update, make_context(bot, application, []))
+            latencies.append(time.perf_counter() - started_at)
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*(one_request(number) for number in range(args.requests)))
+    elapsed = time.perf_counter() - started_at
+    return {
+        'scenario': f"/{command}",
+        'throughput': len(latencies) / elapsed,
+        'p50': percentile(latencies, 50) * 1000,
+        'p95': percentile(latencies, 95) * 1000,
+        'p99': percentile(latencies, 99) * 1000,
+        'db_per_request': (sum(stub.calls.values()) - calls_before) / max(1, len(latencies)),
+    }
+
+async def run_broadcast_scenario(command, handler, command_args, args, stub, bot):
+    await reset_state(args.cold)
+    application = FakeApplication(bot)
+    update = make_update(0, 0, f"/{command}", bot)
+    started_at = time.perf_counter()
+    await handler(update, make_context(bot, application, command_args))
+    returned_after = time.perf_counter() - started_at
+    await asyncio.gather(*(run.task for run in list(main.active_broadcasts.values())))
+    elapsed = time.perf_counter() - started_at
+    return {
+        'scenario': f"/{command} {' '.join(command_args[:-1])}".strip(),
+        'returned_ms': returned_after * 1000,
+        'completion_s': elapsed,
+        'sent': bot.sent,
+        'retry_after': bot.retry_after,
+    }
+
+async def run_startup_scenario(stub, bot):
+    # Холодный старт без сети: фабрика приложения, настоящий клиент Supabase (запросы потом идут
+    # в заглушку), post_init с фоновым прогревом кэшей и первый /start через зарегистрированный обработчик
+    stages = [("импорт main.py", MAIN_IMPORT_SECONDS)]
+    started_at = time.perf_counter()
+    application = main.build_application()
+    stages.append(("build_application()", time.perf_counter() - started_at))
+
+    main.supabase = None
+    started_at = time.perf_counter()
+    main.init_db_client()
+    stages.append(("клиент Supabase", time.perf_counter() - started_at))
+    await main.db_http_session.aclose()
+    main.supabase = stub
+    await reset_state(cold=True)
+
+    started_at = time.perf_counter()
+    await main.on_startup(application)
+    handler = next(handler for handler in application.handlers[0] if 'start' in getattr(handler, 'commands', ()))
+    await handler.callback(make_update(0, 1, "/start", bot), make_context(bot, FakeApplication(bot), []))
+    stages.append(("post_init и первый /start", time.perf_counter() - started_at))
+    await main.cache_warmup_task
+    warmed_after = time.perf_counter() - started_at
+    await main.cancel_background_tasks()
+    return stages, warmed_after
+
+async def run(args):
+    random.seed(args.seed)
+    stub = StubSupabase(build_tables(args.employees, args.registered), args.db_latency_ms / 1000, args.db_jitter_ms / 1000)
+    main.supabase = stub
+    scenarios = set(args.scenarios.split(','))
+
+    if 'startup' in scenarios:
+        bot = FakeBot(args.tg_latency_ms / 1000, args.tg_rate, 1.0, enforce_limits=False)
+        stages, warmed_after = await run_startup_scenario(stub, bot)
+        print("Холодный старт:")
+        for stage, seconds in stages:
+            print(f"{stage:<28}{seconds * 1000:>10.1f} мс")
+        print(f"{'до первого ответа, всего':<28}{sum(seconds for _, seconds in stages) * 1000:>10.1f} мс")
+        print(f"{'кэши прогреты в фоне через':<28}{warmed_after * 1000:>10.1f} мс после post_init\n")
+
+    if 'handlers' in scenarios:
+        bot = FakeBot(args.tg_latency_ms / 1000, args.tg_rate, 1.0, enforce_limits=args.reply_limits)
+        print(f"Обработчики: {args.requests} запросов, параллельно {args.concurrency}, задержка БД {args.db_latency_ms}±{args.db_jitter_ms} мс, кэши {'холодные' if args.cold else 'прогреты'}")
+        print(f"{'команда':<12}{'rps':>10}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'БД/запрос':>11}")
+        for command, handler in (('start', main.start), ('menu', main.menu), ('breakfast', main.breakfast), ('lunch', main.lunch), ('dinner', main.dinner), ('cos', main.cos)):
+            result = await run_handler_scenario(command, handler, args, stub, bot)
+            print(f"{result['scenario']:<12}{result['throughput']:>10.1f}{result['p50']:>10.1f}{result['p95']:>10.1f}{result['p99']:>10.1f}{result['db_per_request']:>11.2f}")
+
+    if 'broadcast' in scenarios:
+        print(f"\nРассылки: лимит фейкового Telegram {args.tg_rate} сообщений/с и 1 сообщение/с в чат")
+        print(f"{'команда':<26}{'ответ, мс':>11}{'завершение, с':>15}{'доставлено':>12}{'RetryAfter':>12}")
+        for command, handler, command_args in (
+            ('broadcast', main.broadcast, ["Тест"]),
+            ('broadcast_team', main.broadcast_team, ["Команда1", "Тест"]),
+        ):
+            # Новый бот на каждый сценарий, чтобы лимиты предыдущей рассылки не влияли на следующую
+            bot = FakeBot(args.tg_latency_ms / 1000, args.tg_rate, 1.0, enforce_limits=True)
+            result = await run_broadcast_scenario(command, handler, command_args, args, stub, bot)
+            print(f"{result['scenario']:<26}{result['returned_ms']:>11.1f}{result['completion_s']:>15.2f}{result['sent']:>12}{result['retry_after']:>12}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк обработчиков бота с заглушками Supabase и Telegram")
+    parser.add_argument('--scenarios', default='startup,handlers,broadcast', help="через запятую: startup, handlers, broadcast")
+    parser.add_argument('--employees', type=int, default=300, help="сотрудников в 'persinfo'")
+    parser.add_argument('--registered', type=float, default=1.0, help="доля сотрудников, запускавших бота")
+    parser.add_argument('--requests', type=int, default=1000, help="запросов на каждую команду")
+    parser.add_argument('--concurrency', type=int, default=100, help="одновременных запросов")
+    parser.add_argument('--db-latency-ms', type=float, default=40.0)
+    parser.add_argument('--db-jitter-ms', type=float, default=10.0)
+    parser.add_argument('--tg-latency-ms', type=float, default=30.0)
+    parser.add_argument('--tg-rate', type=int, default=30, help="глобальный лимит фейкового Telegram, сообщений/с")
+    parser.add_argument('--reply-limits', action='store_true', help="применять лимиты Telegram и к ответам на команды")
+    parser.add_argument('--cold', action='store_true', help="не прогревать справочник и снимки статистики")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--verbose', action='store_true', help="не приглушать логи бота")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    cli_args = parse_args()
+    if not cli_args.verbose:
+        logging.getLogger('main').setLevel(logging.WARNING)
+        logging.getLogger('apscheduler').setLevel(logging.WARNING)
+    asyncio.run(run(cli_args))
+    sys.exit(0)
@@ -1,11 +1,28 @@
+from __future__ import annotations
+
 import os
 import logging
 import time
-from functools import wraps
-from datetime import datetime
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo
-from telegram.ext import Application, CommandHandler, ContextTypes, CallbackQueryHandler
-from supabase import create_client, Client
+import asyncio
+import hmac
+import importlib.util
+import json
+import signal
+import sqlite3
+import threading
+from functools import lru_cache, wraps
+from bisect import bisect_left
+from collections import Counter, OrderedDict
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING
+
+# telegram, supabase, httpx, tornado и redis вместе импортируются около секунды, поэтому
+# грузятся при первом использовании: импорт модуля не тянет сеть и тяжёлые зависимости.
+if TYPE_CHECKING:
+    from telegram import Update
+    from telegram.ext import Application, ContextTypes
+    from supabase import AsyncClient
 
 # --- БЛОК 1: ИНИЦИАЛИЗАЦИЯ И КОНФИГУРАЦИЯ ---
 logging.basicConfig(
@@ -13,15 +30,58 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-try:
-    BOT_TOKEN = os.environ['BOT_TOKEN']
-    SUPABASE_URL = os.environ['SUPABASE_URL']
-    SUPABASE_KEY = os.environ['SUPABASE_KEY']
-except KeyError:
-    logger.error("КРИТИЧЕСКАЯ ОШИБКА: Ключи доступа не найдены! Укажите их в переменных окружения.")
-    exit()
+# Наличие ключей проверяет check_config() при запуске, а не импорт модуля
+BOT_TOKEN = os.environ.get('BOT_TOKEN', '')
+SUPABASE_URL = os.environ.get('SUPABASE_URL', '')
+SUPABASE_KEY = os.environ.get('SUPABASE_KEY', '')
+
+# Режим получения апдейтов: 'polling' (по умолчанию) или 'webhook'
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/telegram')
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', '8080'))
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get('WEBHOOK_MAX_CONNECTIONS', '40'))
+
+# Параллельность обработки апдейтов и пул соединений к Bot API
+BOT_CONCURRENT_UPDATES = int(os.environ.get('BOT_CONCURRENT_UPDATES', '256'))
+BOT_CONNECTION_POOL_SIZE = int(os.environ.get('BOT_CONNECTION_POOL_SIZE', '64'))
+BOT_POOL_TIMEOUT = float(os.environ.get('BOT_POOL_TIMEOUT', '5'))
+
+# Число процессов-обработчиков: при BOT_WORKERS > 1 главный процесс только принимает апдейты
+# и раскладывает их по процессам по id пользователя (см. блок с диспетчером).
+BOT_WORKERS = int(os.environ.get('BOT_WORKERS', '1'))
+
+# Пул keep-alive соединений к PostgREST: одновременные апдейты не ждут друг друга,
+# а переиспользуют уже открытые TCP/TLS-соединения.
+DB_MAX_CONNECTIONS = int(os.environ.get('DB_MAX_CONNECTIONS', '20'))
+DB_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get('DB_MAX_KEEPALIVE_CONNECTIONS', '10'))
+DB_KEEPALIVE_EXPIRY = float(os.environ.get('DB_KEEPALIVE_EXPIRY', '30'))
+DB_TIMEOUT = float(os.environ.get('DB_TIMEOUT', '10'))
+DB_PAGE_SIZE = int(os.environ.get('DB_PAGE_SIZE', '1000'))
+DB_IN_FILTER_CHUNK = int(os.environ.get('DB_IN_FILTER_CHUNK', '200'))
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# Клиент и пул создаются в init_db_client() из post_init, уже внутри event loop бота
+db_http_session = None
+supabase: AsyncClient | None = None
+
+def init_db_client() -> None:
+    global db_http_session, supabase
+    if supabase is not None:
+        return
+    import httpx
+    from supabase import AsyncClient, AsyncClientOptions
+    db_http_session = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=DB_MAX_CONNECTIONS,
+            max_keepalive_connections=DB_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=DB_KEEPALIVE_EXPIRY,
+        ),
+        timeout=DB_TIMEOUT,
+        follow_redirects=True,
+    )
+    supabase = AsyncClient(SUPABASE_URL, SUPABASE_KEY, AsyncClientOptions(httpx_client=db_http_session))
 
 # --- БЛОК 2: КОНФИГУРАЦИЯ НАЗВАНИЙ КОЛОНОК В SUPABASE ---
 USERS_TABLE_TG_ID_COLUMN = 'tg_id'
@@ -35,6 +95,11 @@ PERSINFO_TABLE_PLAN_LID_COLUMN = 'plan_lid'
 PERSINFO_TABLE_RGTM_COLUMN = 'tg_rgtm'
 PERSINFO_TABLE_TEAMLEAD_COLUMN = 'tg_teamlid'
 PERSINFO_TABLE_URL_COLUMN = 'url' # <-- НОВАЯ КОЛОНКА
+PERSINFO_COLUMNS = (
+    PERSINFO_TABLE_TG_USERNAME_COLUMN, PERSINFO_TABLE_FULL_NAME_COLUMN, PERSINFO_TABLE_CITY_COLUMN,
+    PERSINFO_TABLE_TEAM_COLUMN, PERSINFO_TABLE_DOLG_COLUMN, PERSINFO_TABLE_PLAN_LID_COLUMN,
+    PERSINFO_TABLE_RGTM_COLUMN, PERSINFO_TABLE_TEAMLEAD_COLUMN, PERSINFO_TABLE_URL_COLUMN,
+)
 
 TMDAY_TABLE_TG_USERNAME_COLUMN = 'tg'
 TMDAY_TABLE_LID_COLUMN = 'lid'
@@ -52,52 +117,787 @@ URL_ALMANAC = "https://aleksei23122012.github.io/DMdashbordbot/ov/ov.html"
 URL_YUMMY_FORM = "https://forms.gle/KML4YXA4osd6aaWS7"
 URL_GAMIFICATION = "https://marketing-house-appp.vercel.app/"
 
-# --- БЛОК 4: ДЕКОРАТОР ДЛЯ ПРОВЕРКИ АДМИНА ---
-def admin_only(func):
-    @wraps(func)
-    async def wrapped(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
-        user = update.effective_user
-        if not user or not user.username:
-            await update.message.reply_text("Для использования админ-команд у вас должен быть установлен логин (username) в Telegram.")
-            return
+# Ссылки можно переопределить JSON-файлом вида {"URL_DASHBOARD": "https://..."}: он перечитывается
+# при изменении (проверка раз в MENU_CONFIG_CHECK_INTERVAL секунд) или командой /reload_urls.
+MENU_CONFIG_PATH = os.environ.get('MENU_CONFIG_PATH', '')
+MENU_CONFIG_CHECK_INTERVAL = float(os.environ.get('MENU_CONFIG_CHECK_INTERVAL', '60'))
+MENU_URL_NAMES = ('URL_KNOWLEDGE_BASE', 'URL_DASHBOARD', 'URL_ALMANAC', 'URL_YUMMY_FORM', 'URL_GAMIFICATION')
+menu_config_mtime = None
+
+def reload_urls():
+    global menu_config_mtime
+    # Время изменения запоминаем только после успешного разбора: испорченный файл перечитаем на следующей проверке
+    mtime = os.path.getmtime(MENU_CONFIG_PATH)
+    with open(MENU_CONFIG_PATH, encoding='utf-8') as config_file:
+        overrides = json.load(config_file)
+    if not isinstance(overrides, dict):
+        raise ValueError("ожидается JSON-объект вида {\"URL_DASHBOARD\": \"https://...\"}")
+    invalid = [name for name in MENU_URL_NAMES if name in overrides and not isinstance(overrides[name], str)]
+    if invalid:
+        raise ValueError(f"значения должны быть строками: {', '.join(invalid)}")
+    menu_config_mtime = mtime
+    changed = [name for name in MENU_URL_NAMES if name in overrides and overrides[name] != globals()[name]]
+    for name in changed:
+        globals()[name] = overrides[name]
+    _static_menu_rows.cache_clear()
+    _build_menu.cache_clear()
+    return changed
+
+async def watch_menu_config_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        if MENU_CONFIG_PATH and os.path.getmtime(MENU_CONFIG_PATH) != menu_config_mtime:
+            changed = reload_urls()
+            logger.info(f"Ссылки меню перечитаны из {MENU_CONFIG_PATH}, изменены: {', '.join(changed) or 'нет'}")
+    except Exception as e:
+        logger.error(f"Не удалось перечитать ссылки меню из {MENU_CONFIG_PATH}: {e}")
+
+# --- БЛОК 4: МЕТРИКИ ПРОИЗВОДИТЕЛЬНОСТИ ---
+# Гистограммы задержек обработчиков и запросов к Supabase, счётчики ошибок и лаг event loop.
+# Наблюдение стоит один bisect и пару сложений, поэтому метрики включены всегда.
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '0'))
+LOOP_LAG_INTERVAL = float(os.environ.get('LOOP_LAG_INTERVAL', '0.5'))
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def percentile(self, percent):
+        # Оценка по границам корзин с линейной интерполяцией внутри корзины
+        if not self.count:
+            return 0.0
+        rank = self.count * percent / 100
+        cumulative = 0
+        for index, bucket_count in enumerate(self.counts):
+            if cumulative + bucket_count >= rank and bucket_count:
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+        return self.buckets[-1]
+
+class Metrics:
+    def __init__(self):
+        self.handler_latency = {}
+        self.handler_errors = Counter()
+        self.db_latency = {}
+        self.db_errors = Counter()
+        self.loop_lag = Histogram((0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+        self.loop_lag_max = 0.0
+
+    def observe_handler(self, name, seconds):
+        self.handler_latency.setdefault(name, Histogram()).observe(seconds)
+
+    def observe_db(self, table, seconds):
+        self.db_latency.setdefault(table, Histogram()).observe(seconds)
+
+    def observe_loop_lag(self, seconds):
+        self.loop_lag.observe(seconds)
+        self.loop_lag_max = max(self.loop_lag_max, seconds)
+
+    def render_prometheus(self):
+        lines = []
+        self._render_histograms(lines, "bot_handler_latency_seconds", "handler", self.handler_latency)
+        self._render_counter(lines, "bot_handler_errors_total", "handler", self.handler_errors)
+        self._render_histograms(lines, "bot_supabase_latency_seconds", "table", self.db_latency)
+        self._render_counter(lines, "bot_supabase_errors_total", "table", self.db_errors)
+        self._render_histograms(lines, "bot_event_loop_lag_seconds", None, {None: self.loop_lag})
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _render_histograms(lines, name, label, histograms):
+        lines.append(f"# TYPE {name} histogram")
+        for label_value, histogram in histograms.items():
+            prefix = f'{label}="{label_value}",' if label else ""
+            cumulative = 0
+            for bound, bucket_count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            labels = f"{{{prefix.rstrip(',')}}}" if label else ""
+            lines.append(f"{name}_sum{labels} {histogram.total}")
+            lines.append(f"{name}_count{labels} {histogram.count}")
+
+    @staticmethod
+    def _render_counter(lines, name, label, counter):
+        lines.append(f"# TYPE {name} counter")
+        for label_value, value in counter.items():
+            lines.append(f'{name}{{{label}="{label_value}"}} {value}')
+
+metrics = Metrics()
+current_handler = ContextVar('current_handler', default=None)
+
+def count_handler_error():
+    # Обработчики сами ловят исключения и отвечают текстом ошибки, до обёртки они не доходят,
+    # поэтому обработанный сбой отмечается явно из блока except
+    name = current_handler.get()
+    if name:
+        metrics.handler_errors[name] += 1
+
+def instrument_handler(name, callback):
+    @wraps(callback)
+    async def wrapped(update, context):
+        started_at = time.perf_counter()
+        token = current_handler.set(name)
         try:
-            response = supabase.table('persinfo').select(PERSINFO_TABLE_DOLG_COLUMN).eq(PERSINFO_TABLE_TG_USERNAME_COLUMN, user.username).execute()
-            if response.data and response.data[0].get(PERSINFO_TABLE_DOLG_COLUMN) == "Админ":
-                return await func(update, context, *args, **kwargs)
+            return await callback(update, context)
+        except Exception:
+            metrics.handler_errors[name] += 1
+            raise
+        finally:
+            current_handler.reset(token)
+            metrics.observe_handler(name, time.perf_counter() - started_at)
+    return wrapped
+
+def instrument_application(application: Application) -> None:
+    from telegram.ext import CommandHandler
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            if isinstance(handler, CommandHandler):
+                name = "/" + sorted(handler.commands)[0]
             else:
+                name = type(handler).__name__
+            handler.callback = instrument_handler(name, handler.callback)
+
+async def monitor_event_loop_lag() -> None:
+    # Насколько позже запланированного просыпается sleep - столько event loop был занят чужой работой
+    while True:
+        expected = time.perf_counter() + LOOP_LAG_INTERVAL
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        metrics.observe_loop_lag(max(0.0, time.perf_counter() - expected))
+
+def metrics_endpoint(request):
+    request.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+    request.write(metrics.render_prometheus())
+
+@lru_cache(maxsize=None)
+def _endpoint_handler_class():
+    import tornado.web
+
+    class EndpointHandler(tornado.web.RequestHandler):
+        def initialize(self, get=None, post=None):
+            self.endpoints = {'GET': get, 'POST': post}
+
+        async def _call_endpoint(self):
+            endpoint = self.endpoints[self.request.method]
+            if endpoint is None:
+                raise tornado.web.HTTPError(405)
+            result = endpoint(self)
+            if asyncio.iscoroutine(result):
+                await result
+
+        get = post = _call_endpoint
+
+    return EndpointHandler
+
+def make_http_server(routes):
+    # tornado нужен только для webhook и /metrics, поэтому импортируется при первом запуске сервера.
+    # routes: [(путь, {'get': функция(request), 'post': ...})]
+    import tornado.httpserver
+    import tornado.web
+    handler_class = _endpoint_handler_class()
+    return tornado.httpserver.HTTPServer(tornado.web.Application([(path, handler_class, methods) for path, methods in routes]))
+
+# --- БЛОК 5: АСИНХРОННЫЙ СЛОЙ ДОСТУПА К ДАННЫМ ---
+# Все обращения к Supabase идут только через эти функции: они не блокируют event loop,
+# поэтому запросы разных операторов выполняются параллельно.
+async def _execute(table, query):
+    started_at = time.perf_counter()
+    try:
+        return await query.execute()
+    except Exception:
+        metrics.db_errors[table] += 1
+        raise
+    finally:
+        metrics.observe_db(table, time.perf_counter() - started_at)
+
+async def db_get_persinfo(username, *columns):
+    response = await _execute('persinfo', supabase.table('persinfo').select(", ".join(columns)).eq(PERSINFO_TABLE_TG_USERNAME_COLUMN, username))
+    return response.data[0] if response.data else None
+
+async def db_get_tmday(username):
+    response = await _execute('TMday', supabase.table('TMday').select(f"{TMDAY_TABLE_LID_COLUMN}, {TMDAY_TABLE_TRAFIC_COLUMN}, {TMDAY_TABLE_KZ_COLUMN}").eq(TMDAY_TABLE_TG_USERNAME_COLUMN, username))
+    return response.data[0] if response.data else None
+
+async def db_get_tmmonth(username):
+    response = await _execute('TMmonth', supabase.table('TMmonth').select(f"{TMMONTH_TABLE_COS_COLUMN}, {TMMONTH_TABLE_MOLNII_COLUMN}").eq(TMMONTH_TABLE_TG_USERNAME_COLUMN, username))
+    return response.data[0] if response.data else None
+
+async def db_upsert_users(rows):
+    await _execute('users', supabase.table('users').upsert(rows, on_conflict=USERS_TABLE_TG_ID_COLUMN))
+
+async def db_count_users():
+    # head=True: PostgREST считает строки на сервере и не присылает их в ответе
+    response = await _execute('users', supabase.table('users').select(USERS_TABLE_TG_ID_COLUMN, count='exact', head=True))
+    return response.count
+
+async def db_delete_users(tg_ids):
+    # Длинный фильтр in.(...) упирается в длину URL, поэтому удаляем порциями
+    for offset in range(0, len(tg_ids), DB_IN_FILTER_CHUNK):
+        await _execute('users', supabase.table('users').delete().in_(USERS_TABLE_TG_ID_COLUMN, tg_ids[offset:offset + DB_IN_FILTER_CHUNK]))
+
+async def db_fetch_all(table, *columns):
+    # PostgREST отдаёт не больше max-rows строк за запрос, поэтому большие таблицы читаем страницами
+    rows = []
+    while True:
+        response = await _execute(table, supabase.table(table).select(", ".join(columns)).order(columns[0]).range(len(rows), len(rows) + DB_PAGE_SIZE - 1))
+        rows.extend(response.data)
+        if len(response.data) < DB_PAGE_SIZE:
+            return rows
+
+async def db_get_all_user_ids():
+    rows = await db_fetch_all('users', USERS_TABLE_TG_ID_COLUMN)
+    return [user[USERS_TABLE_TG_ID_COLUMN] for user in rows]
+
+async def db_get_usernames_by(filter_column, filter_value):
+    response = await _execute('persinfo', supabase.table('persinfo').select(PERSINFO_TABLE_TG_USERNAME_COLUMN).eq(filter_column, filter_value))
+    return [user[PERSINFO_TABLE_TG_USERNAME_COLUMN] for user in response.data]
+
+async def db_get_user_ids_by_usernames(usernames):
+    # Как и в db_delete_users, фильтр in.(...) отправляем порциями, чтобы не упереться в длину URL
+    user_ids = []
+    for offset in range(0, len(usernames), DB_IN_FILTER_CHUNK):
+        response = await _execute('users', supabase.table('users').select(USERS_TABLE_TG_ID_COLUMN).in_(USERS_TABLE_TG_USERNAME_COLUMN, usernames[offset:offset + DB_IN_FILTER_CHUNK]))
+        user_ids.extend(user[USERS_TABLE_TG_ID_COLUMN] for user in response.data)
+    return user_ids
+
+async def db_close(application: Application) -> None:
+    if db_http_session is not None:
+        await db_http_session.aclose()
+    if cache_redis is not None:
+        await cache_redis.aclose()
+
+# --- БЛОК 6: БЭКЕНД КЭШЕЙ ---
+# Кэши профилей и статистики хранят данные через бэкенд: по умолчанию словарь в памяти процесса,
+# с CACHE_BACKEND=redis - общий Redis-совместимый сервер (Redis, Valkey, KeyDB), который видят
+# все процессы-обработчики. Пакет redis нужен только во втором случае.
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'memory')
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+CACHE_KEY_PREFIX = os.environ.get('CACHE_KEY_PREFIX', 'conc')
+cache_redis = None
+
+def get_cache_redis():
+    global cache_redis
+    if cache_redis is None:
+        import redis.asyncio as redis_asyncio
+        cache_redis = redis_asyncio.from_url(REDIS_URL)
+    return cache_redis
+
+class MemoryCacheBackend:
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        # ключ -> (момент истечения по time.monotonic, значение)
+        self.entries = OrderedDict()
+
+    async def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def _put(self, key, value, expires_at):
+        self.entries[key] = (expires_at, value)
+        self.entries.move_to_end(key)
+        if self.max_size:
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    async def set(self, key, value, ttl):
+        self._put(key, value, time.monotonic() + ttl)
+
+    async def replace(self, items, ttl):
+        # Новое содержимое целиком: ключей, которых нет в items, больше не будет
+        expires_at = time.monotonic() + ttl
+        self.entries = OrderedDict()
+        for key, value in items.items():
+            self._put(key, value, expires_at)
+
+    async def delete(self, key):
+        return self.entries.pop(key, None) is not None
+
+    async def clear(self):
+        removed = len(self.entries)
+        self.entries.clear()
+        return removed
+
+    async def size(self):
+        return len(self.entries)
+
+class RedisCacheBackend:
+    max_size = None
+
+    def __init__(self, namespace):
+        self.prefix = f"{CACHE_KEY_PREFIX}:{namespace}:"
+
+    @property
+    def client(self):
+        # Подключение создаётся при первом обращении к кэшу, а не при импорте
+        return get_cache_redis()
+
+    async def get(self, key):
+        raw = await self.client.get(self.prefix + key)
+        return None if raw is None else json.loads(raw)
+
+    async def set(self, key, value, ttl):
+        await self.client.set(self.prefix + key, json.dumps(value, ensure_ascii=False), px=int(ttl * 1000))
+
+    async def replace(self, items, ttl):
+        # MULTI/EXEC: другие процессы видят либо старое содержимое, либо новое целиком
+        stale_keys = await self._keys()
+        pipeline = self.client.pipeline(transaction=True)
+        if stale_keys:
+            pipeline.delete(*stale_keys)
+        for key, value in items.items():
+            pipeline.set(self.prefix + key, json.dumps(value, ensure_ascii=False), px=int(ttl * 1000))
+        await pipeline.execute()
+
+    async def delete(self, key):
+        return await self.client.delete(self.prefix + key) > 0
+
+    async def _keys(self):
+        return [key async for key in self.client.scan_iter(match=self.prefix + '*', count=1000)]
+
+    async def clear(self):
+        keys = await self._keys()
+        for start in range(0, len(keys), 1000):
+            await self.client.delete(*keys[start:start + 1000])
+        return len(keys)
+
+    async def size(self):
+        return len(await self._keys())
+
+def make_cache_backend(namespace, max_size=None):
+    if CACHE_BACKEND == 'redis':
+        return RedisCacheBackend(namespace)
+    return MemoryCacheBackend(max_size)
+
+# --- БЛОК 7: КЭШ ПРОФИЛЕЙ СОТРУДНИКОВ ---
+# Профиль из 'persinfo' меняется редко, поэтому строка целиком грузится один раз
+# и дальше отдаётся из бэкенда кэша всем обработчикам до истечения TTL.
+PROFILE_CACHE_TTL = float(os.environ.get('PROFILE_CACHE_TTL', '300'))
+PROFILE_CACHE_MAX_SIZE = int(os.environ.get('PROFILE_CACHE_MAX_SIZE', '5000'))
+
+class ProfileCache:
+    def __init__(self, backend, ttl):
+        self.backend = backend
+        self.ttl = ttl
+        self.loading = {}
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, username):
+        profile = await self.backend.get(username)
+        if profile is not None:
+            self.hits += 1
+            return profile
+        self.misses += 1
+        # Одновременные промахи по одному логину ждут один общий запрос в БД
+        task = self.loading.get(username)
+        if task is None:
+            task = asyncio.ensure_future(self._load(username))
+            self.loading[username] = task
+        return await task
+
+    async def _load(self, username):
+        generation = self.generation
+        try:
+            profile = await db_get_persinfo(username, *PERSINFO_COLUMNS)
+            if profile is not None and generation == self.generation:
+                await self.backend.set(username, profile, self.ttl)
+            return profile
+        finally:
+            self.loading.pop(username, None)
+
+    async def invalidate(self, username=None):
+        self.generation += 1
+        if username is None:
+            return await self.backend.clear()
+        return 1 if await self.backend.delete(username) else 0
+
+    async def stats_text(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total * 100 if total else 0.0
+        size = await self.backend.size()
+        capacity = f"/{self.backend.max_size}" if self.backend.max_size else ""
+        return f"Профилей в кэше: {size}{capacity}, попаданий: {self.hits}, промахов: {self.misses} ({hit_rate:.1f}% попаданий)"
+
+profile_cache = ProfileCache(make_cache_backend('profiles', PROFILE_CACHE_MAX_SIZE), PROFILE_CACHE_TTL)
+
+# --- БЛОК 8: СПРАВОЧНИК СОТРУДНИКОВ ДЛЯ АДРЕСНЫХ РАССЫЛОК ---
+# 'persinfo' и 'users' склеиваются один раз за период обновления, а получатели
+# адресных рассылок берутся из индексов "значение колонки -> множество tg_id".
+DIRECTORY_REFRESH_INTERVAL = float(os.environ.get('DIRECTORY_REFRESH_INTERVAL', '600'))
+DIRECTORY_INDEX_COLUMNS = (
+    PERSINFO_TABLE_TEAM_COLUMN, PERSINFO_TABLE_CITY_COLUMN, PERSINFO_TABLE_DOLG_COLUMN,
+    PERSINFO_TABLE_TEAMLEAD_COLUMN, PERSINFO_TABLE_RGTM_COLUMN,
+)
+
+class Directory:
+    def __init__(self):
+        self.all_ids = set()
+        self.indexes = {column: {} for column in DIRECTORY_INDEX_COLUMNS}
+        # Строки 'persinfo' и логины пользователей бота нужны, чтобы дополнять индексы регистрациями
+        # между обновлениями, не дожидаясь DIRECTORY_REFRESH_INTERVAL
+        self.persinfo_by_username = {}
+        self.username_by_id = {}
+        self.loaded_at = None
+
+    async def refresh(self):
+        persinfo_rows, users_rows = await asyncio.gather(
+            db_fetch_all('persinfo', PERSINFO_TABLE_TG_USERNAME_COLUMN, *DIRECTORY_INDEX_COLUMNS),
+            db_fetch_all('users', USERS_TABLE_TG_ID_COLUMN, USERS_TABLE_TG_USERNAME_COLUMN),
+        )
+        self.rebuild(persinfo_rows, users_rows)
+        registration_queue.seed(users_rows)
+        # Те же строки 'persinfo' содержат всё нужное для ролей - отдельный запрос не нужен
+        role_registry.rebuild(persinfo_rows)
+
+    def rebuild(self, persinfo_rows, users_rows):
+        ids_by_username = {}
+        for row in users_rows:
+            ids_by_username.setdefault(row.get(USERS_TABLE_TG_USERNAME_COLUMN), set()).add(row[USERS_TABLE_TG_ID_COLUMN])
+        indexes = {column: {} for column in DIRECTORY_INDEX_COLUMNS}
+        for row in persinfo_rows:
+            # Пустое множество тоже сохраняем: сотрудники с таким значением есть, но бота ещё не запускали
+            tg_ids = ids_by_username.get(row.get(PERSINFO_TABLE_TG_USERNAME_COLUMN), set())
+            for column in DIRECTORY_INDEX_COLUMNS:
+                value = row.get(column)
+                if value is not None:
+                    indexes[column].setdefault(value, set()).update(tg_ids)
+        self.all_ids = {row[USERS_TABLE_TG_ID_COLUMN] for row in users_rows}
+        self.indexes = indexes
+        self.persinfo_by_username = {row[PERSINFO_TABLE_TG_USERNAME_COLUMN]: row for row in persinfo_rows if row.get(PERSINFO_TABLE_TG_USERNAME_COLUMN)}
+        self.username_by_id = {row[USERS_TABLE_TG_ID_COLUMN]: row.get(USERS_TABLE_TG_USERNAME_COLUMN) for row in users_rows}
+        self.loaded_at = datetime.now()
+        logger.info(f"Справочник обновлён: {len(persinfo_rows)} сотрудников, {len(self.all_ids)} пользователей бота.")
+
+    def breakdown(self, column, limit):
+        counts = [(value, len(tg_ids)) for value, tg_ids in self.indexes[column].items() if tg_ids]
+        counts.sort(key=lambda item: -item[1])
+        return counts[:limit], len(counts)
+
+    def discard(self, tg_ids):
+        self.all_ids.difference_update(tg_ids)
+        for tg_id in tg_ids:
+            self.username_by_id.pop(tg_id, None)
+        for index in self.indexes.values():
+            for index_ids in index.values():
+                index_ids.difference_update(tg_ids)
+
+    def add_users(self, registrations):
+        # Записанные регистрации (tg_id, логин): новый пользователь или смена логина сразу попадают
+        # в адресные рассылки. До первой загрузки дополнять нечего - refresh() прочитает их из БД
+        if not self.loaded_at:
+            return
+        for tg_id, username in registrations:
+            if tg_id in self.all_ids and self.username_by_id.get(tg_id) == username:
+                continue
+            self._unindex(tg_id, self.persinfo_by_username.get(self.username_by_id.get(tg_id)))
+            self.all_ids.add(tg_id)
+            self.username_by_id[tg_id] = username
+            row = self.persinfo_by_username.get(username)
+            if row:
+                for column in DIRECTORY_INDEX_COLUMNS:
+                    value = row.get(column)
+                    if value is not None:
+                        self.indexes[column].setdefault(value, set()).add(tg_id)
+
+    def _unindex(self, tg_id, row):
+        if row:
+            for column in DIRECTORY_INDEX_COLUMNS:
+                self.indexes[column].get(row.get(column), set()).discard(tg_id)
+
+    def select(self, criteria):
+        # None - ни один сотрудник не подходит хотя бы под один критерий
+        result = None
+        for column, value in criteria.items():
+            tg_ids = self.indexes[column].get(value)
+            if tg_ids is None:
+                return None
+            result = set(tg_ids) if result is None else result & tg_ids
+        return result
+
+directory = Directory()
+
+async def refresh_directory_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        await directory.refresh()
+    except Exception as e:
+        logger.error(f"Не удалось обновить справочник сотрудников: {e}")
+
+# --- БЛОК 9: СНИМОК ДНЕВНОЙ И МЕСЯЧНОЙ СТАТИСТИКИ ---
+# 'TMday' и 'TMmonth' обновляются по расписанию, поэтому вместо запроса на каждого
+# оператора таблицы целиком перечитываются раз в интервал и читаются из бэкенда кэша.
+# Строка старше STATS_SNAPSHOT_MAX_AGE секунд считается устаревшей, и за ней идём напрямую в БД.
+STATS_SNAPSHOT_INTERVAL = float(os.environ.get('STATS_SNAPSHOT_INTERVAL', '300'))
+STATS_SNAPSHOT_MAX_AGE = float(os.environ.get('STATS_SNAPSHOT_MAX_AGE', str(STATS_SNAPSHOT_INTERVAL * 2)))
+
+class StatsSnapshot:
+    # Логины Telegram не содержат '#', поэтому служебный ключ не пересечётся со строками
+    META_KEY = '#meta'
+
+    def __init__(self, table, key_column, columns, fallback):
+        self.table = table
+        self.key_column = key_column
+        self.columns = columns
+        self.fallback = fallback
+        # логин -> [время загрузки, значения колонок в порядке self.columns]
+        self.backend = make_cache_backend(f"snapshot:{table}")
+        self.loaded_at = None
+        self.hits = 0
+        self.misses = 0
+
+    async def refresh(self):
+        rows = await db_fetch_all(self.table, self.key_column, *self.columns)
+        loaded_at = time.time()
+        # Снимок заменяется целиком, чтобы строки, удалённые из таблицы, не отдавались дальше.
+        # Строки без логина пропускаем: по ним не найти оператора, а ключ None ломает бэкенд Redis
+        entries = {row[self.key_column]: [loaded_at, [row.get(column) for column in self.columns]] for row in rows if row.get(self.key_column)}
+        entries[self.META_KEY] = [loaded_at, len(entries)]
+        await self.backend.replace(entries, STATS_SNAPSHOT_MAX_AGE)
+        self.loaded_at = loaded_at
+
+    async def get(self, username):
+        entry = await self.backend.get(username)
+        if entry and time.time() - entry[0] <= STATS_SNAPSHOT_MAX_AGE:
+            self.hits += 1
+            return dict(zip(self.columns, entry[1]))
+        # Промах или устаревшая строка: идём напрямую в БД и дополняем снимок
+        self.misses += 1
+        row = await self.fallback(username)
+        if row is not None:
+            await self.backend.set(username, [time.time(), [row.get(column) for column in self.columns]], STATS_SNAPSHOT_MAX_AGE)
+        return row
+
+    async def stats_text(self):
+        # С общим бэкендом снимок мог загрузить другой процесс, поэтому время берём из кэша
+        meta = await self.backend.get(self.META_KEY)
+        loaded = f"{meta[1]} строк (загружен: {datetime.fromtimestamp(meta[0]).strftime('%H:%M:%S')})" if meta else "ещё не загружен"
+        return f"Снимок '{self.table}': {loaded}, попаданий: {self.hits}, промахов: {self.misses}"
+
+tmday_snapshot = StatsSnapshot('TMday', TMDAY_TABLE_TG_USERNAME_COLUMN, (TMDAY_TABLE_LID_COLUMN, TMDAY_TABLE_TRAFIC_COLUMN, TMDAY_TABLE_KZ_COLUMN), db_get_tmday)
+tmmonth_snapshot = StatsSnapshot('TMmonth', TMMONTH_TABLE_TG_USERNAME_COLUMN, (TMMONTH_TABLE_COS_COLUMN, TMMONTH_TABLE_MOLNII_COLUMN), db_get_tmmonth)
+
+async def refresh_stats_snapshots_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    results = await asyncio.gather(tmday_snapshot.refresh(), tmmonth_snapshot.refresh(), return_exceptions=True)
+    for snapshot, result in zip((tmday_snapshot, tmmonth_snapshot), results):
+        if isinstance(result, Exception):
+            logger.error(f"Не удалось обновить снимок '{snapshot.table}': {result}")
+
+# --- БЛОК 10: ОТЛОЖЕННАЯ РЕГИСТРАЦИЯ ПОЛЬЗОВАТЕЛЕЙ ---
+# /start не пишет в 'users' сразу: уже известные пары (tg_id, логин) отбрасываются локально,
+# а новые пользователи и смены логина копятся и уходят в БД пачкой одним upsert.
+REGISTRATION_FLUSH_INTERVAL = float(os.environ.get('REGISTRATION_FLUSH_INTERVAL', '5'))
+REGISTRATION_BATCH_SIZE = int(os.environ.get('REGISTRATION_BATCH_SIZE', '500'))
+# Если пачка не записалась, строки пишутся по одной: строка, которая не проходит, пока соседние
+# записываются, отбрасывается после REGISTRATION_MAX_ATTEMPTS попыток и не держит очередь.
+REGISTRATION_MAX_ATTEMPTS = int(os.environ.get('REGISTRATION_MAX_ATTEMPTS', '3'))
+# Столько строк подряд без единой удачной записи считаем сбоем БД, а не плохими данными
+REGISTRATION_PROBE_ROWS = int(os.environ.get('REGISTRATION_PROBE_ROWS', '3'))
+
+class RegistrationQueue:
+    def __init__(self):
+        self.known = {}
+        self.pending = {}
+        self.attempts = Counter()
+        self.inserted = 0
+        self.updated = 0
+        self.skipped = 0
+        self.dropped = 0
+
+    def seed(self, users_rows):
+        for row in users_rows:
+            self.known[row[USERS_TABLE_TG_ID_COLUMN]] = row.get(USERS_TABLE_TG_USERNAME_COLUMN)
+
+    def submit(self, tg_id, username):
+        latest = self.pending if tg_id in self.pending else self.known
+        if tg_id in latest and latest[tg_id] == username:
+            self.skipped += 1
+            return
+        self.pending[tg_id] = username
+
+    @staticmethod
+    def _rows(items):
+        return [{USERS_TABLE_TG_ID_COLUMN: tg_id, USERS_TABLE_TG_USERNAME_COLUMN: username} for tg_id, username in items]
+
+    async def _upsert_each(self, items):
+        written, failed, error = [], [], None
+        for item in items:
+            if not written and len(failed) >= REGISTRATION_PROBE_ROWS:
+                failed.append(item)
+                continue
+            try:
+                await db_upsert_users(self._rows([item]))
+                written.append(item)
+            except Exception as e:
+                failed.append(item)
+                error = e
+        return written, failed, error
+
+    async def flush(self):
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, {}
+        items = list(batch.items())
+        written, failed, error = [], [], None
+        for offset in range(0, len(items), REGISTRATION_BATCH_SIZE):
+            chunk = items[offset:offset + REGISTRATION_BATCH_SIZE]
+            try:
+                await db_upsert_users(self._rows(chunk))
+                written += chunk
+            except Exception as e:
+                if len(chunk) == 1:
+                    failed += chunk
+                    error = e
+                    continue
+                logger.warning(f"Пачка из {len(chunk)} регистраций не записана ({e}), пишу по одной.")
+                chunk_written, chunk_failed, chunk_error = await self._upsert_each(chunk)
+                written += chunk_written
+                failed += chunk_failed
+                error = chunk_error or e
+
+        if written:
+            new_count = sum(1 for tg_id, _ in written if tg_id not in self.known)
+            self.inserted += new_count
+            self.updated += len(written) - new_count
+            for tg_id, username in written:
+                self.known[tg_id] = username
+                self.attempts.pop(tg_id, None)
+            # Справочник адресных рассылок есть в каждом процессе-обработчике
+            directory.add_users(written)
+            notify_workers('directory_add_users', written)
+            logger.info(f"Регистрации записаны в БД: новых {new_count}, смен логина {len(written) - new_count}.")
+
+        # Возвращаем в очередь, не затирая то, что пришло за время записи; upsert идемпотентен
+        # Строку, которая уже не прошла рядом с удачными, считаем плохой и дальше - даже при общем сбое
+        for tg_id, username in failed:
+            if written or self.attempts[tg_id]:
+                self.attempts[tg_id] += 1
+                if self.attempts[tg_id] >= REGISTRATION_MAX_ATTEMPTS:
+                    del self.attempts[tg_id]
+                    self.dropped += 1
+                    logger.error(f"Регистрация {tg_id} (@{username}) отброшена после {REGISTRATION_MAX_ATTEMPTS} неудачных попыток: {error}")
+                    continue
+            self.pending.setdefault(tg_id, username)
+        if failed and not written:
+            # Не прошла ни одна строка - похоже на сбой БД: попытки не считаем, пробуем в следующий раз
+            raise error
+
+    def stats_text(self):
+        return (f"Регистрации через /start: новых {self.inserted}, смен логина {self.updated}, "
+                f"без изменений {self.skipped}, в очереди {len(self.pending)}, отброшено {self.dropped}")
+
+registration_queue = RegistrationQueue()
+
+async def flush_registrations_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        await registration_queue.flush()
+    except Exception as e:
+        logger.error(f"Не удалось записать регистрации пользователей: {e}")
+
+# --- БЛОК 11: РОЛИ И ПРОВЕРКА ПРАВ ДОСТУПА ---
+# Составы ролей держатся в памяти целиком, поэтому проверка прав - это поиск в множестве
+# без обращения к БД. Обновляются вместе со справочником или командой /cache_reset.
+ROLE_ADMIN = 'admin'
+ROLE_TEAMLEAD = 'teamlead'
+ROLE_RGTM = 'rgtm'
+ADMIN_DOLG = "Админ"
+
+class RoleRegistry:
+    def __init__(self):
+        self.members = {ROLE_ADMIN: frozenset(), ROLE_TEAMLEAD: frozenset(), ROLE_RGTM: frozenset()}
+        self.loaded_at = None
+        self.lock = asyncio.Lock()
+
+    async def refresh(self):
+        rows = await db_fetch_all('persinfo', PERSINFO_TABLE_TG_USERNAME_COLUMN, PERSINFO_TABLE_DOLG_COLUMN, PERSINFO_TABLE_TEAMLEAD_COLUMN, PERSINFO_TABLE_RGTM_COLUMN)
+        self.rebuild(rows)
+
+    def rebuild(self, persinfo_rows):
+        self.members = {
+            ROLE_ADMIN: frozenset(row.get(PERSINFO_TABLE_TG_USERNAME_COLUMN) for row in persinfo_rows if row.get(PERSINFO_TABLE_DOLG_COLUMN) == ADMIN_DOLG),
+            ROLE_TEAMLEAD: frozenset(row.get(PERSINFO_TABLE_TEAMLEAD_COLUMN) for row in persinfo_rows if row.get(PERSINFO_TABLE_TEAMLEAD_COLUMN)),
+            ROLE_RGTM: frozenset(row.get(PERSINFO_TABLE_RGTM_COLUMN) for row in persinfo_rows if row.get(PERSINFO_TABLE_RGTM_COLUMN)),
+        }
+        self.loaded_at = datetime.now()
+
+    async def ensure_loaded(self):
+        if self.loaded_at is None:
+            async with self.lock:
+                if self.loaded_at is None:
+                    await self.refresh()
+
+    def has_role(self, username, role):
+        return username in self.members[role]
+
+role_registry = RoleRegistry()
+
+def require_role(role):
+    def decorator(func):
+        @wraps(func)
+        async def wrapped(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
+            user = update.effective_user
+            if not user or not user.username:
+                await update.message.reply_text("Для использования админ-команд у вас должен быть установлен логин (username) в Telegram.")
+                return
+            try:
+                await role_registry.ensure_loaded()
+            except Exception as e:
+                count_handler_error()
+                logger.error(f"Ошибка при проверке прав доступа для {user.username}: {e}")
+                await update.message.reply_text("Произошла ошибка при проверке прав доступа.")
+                return
+            if not role_registry.has_role(user.username, role):
                 await update.message.reply_text("У вас нет прав для выполнения этой команды.")
                 return
-        except Exception as e:
-            logger.error(f"Ошибка при проверке прав администратора для {user.username}: {e}")
-            await update.message.reply_text("Произошла ошибка при проверке прав доступа.")
-            return
-    return wrapped
+            return await func(update, context, *args, **kwargs)
+        return wrapped
+    return decorator
+
+admin_only = require_role(ROLE_ADMIN)
 
-# --- БЛОК 5: ОСНОВНЫЕ ФУНКЦИИ ДЛЯ ПОЛЬЗОВАТЕЛЕЙ ---
+# --- БЛОК 12: ОСНОВНЫЕ ФУНКЦИИ ДЛЯ ПОЛЬЗОВАТЕЛЕЙ ---
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     if not user.username:
         await update.message.reply_text("Для авторизации в системе, пожалуйста, установите себе логин (username) в настройках Telegram.")
         return
     logger.info(f"Пользователь {user.username} (ID: {user.id}) нажал /start.")
+    registration_queue.submit(user.id, user.username)
+    if user.id in broadcast_store.blocked_ids:
+        # Нажал /start - значит, снова принимает сообщения
+        try:
+            await broadcast_store.call(broadcast_store.forget_blocked, [user.id])
+            notify_workers('forget_blocked', [user.id])
+        except Exception as e:
+            logger.error(f"Не удалось снять отметку о блокировке для {user.username}: {e}")
     try:
-        supabase.table('users').insert({USERS_TABLE_TG_ID_COLUMN: user.id, USERS_TABLE_TG_USERNAME_COLUMN: user.username}).execute()
-    except Exception:
-        pass
-    try:
-        response = supabase.table('persinfo').select(f"{PERSINFO_TABLE_FULL_NAME_COLUMN}, {PERSINFO_TABLE_CITY_COLUMN}, {PERSINFO_TABLE_TEAM_COLUMN}, {PERSINFO_TABLE_DOLG_COLUMN}").eq(PERSINFO_TABLE_TG_USERNAME_COLUMN, user.username).execute()
-        if not response.data:
+        data = await profile_cache.get(user.username)
+        if not data:
             await update.message.reply_text("Здравствуйте! Я не смог найти вас в базе сотрудников. Обратитесь к администратору.")
             return
-        data = response.data[0]
         full_name = data.get(PERSINFO_TABLE_FULL_NAME_COLUMN, 'N/A')
         city = data.get(PERSINFO_TABLE_CITY_COLUMN, 'N/A')
         team = data.get(PERSINFO_TABLE_TEAM_COLUMN, 'N/A')
         dolg = data.get(PERSINFO_TABLE_DOLG_COLUMN, 'N/A')
         text = f"Здравствуйте, {full_name}! ✋\nВы {dolg} из {team}, из города {city}, верно?"
+        from telegram import InlineKeyboardButton, InlineKeyboardMarkup
         keyboard = [[InlineKeyboardButton("Да, всё верно", callback_data="auth_yes"), InlineKeyboardButton("Нет, не верно", callback_data="auth_no")]]
         await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
     except Exception as e:
+        count_handler_error()
         logger.error(f"Ошибка при поиске пользователя в 'persinfo': {e}")
         await update.message.reply_text("Произошла внутренняя ошибка.")
 
@@ -110,160 +910,136 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     elif query.data == "auth_no":
         await query.edit_message_text(text="Не удивительно, я еще обучаюсь. Пожалуйста, напишите администратору @mikiooshi")
 
+WELCOME_TEXT = (
+    "Твой персональный Консьерж на связи. 🤵\n\n"
+    "Выбирай, что хочешь узнать или сделать:\n\n"
+    "✨ CRM - ссылка на CRM вашей команды 💼\n"
+    "✨ Дашборд — вся важная информация у тебя под рукой 📊\n"
+    "✨ Отработка возражений — шаблоны и рекомендации ⛔️\n"
+    "✨ База знаний — полезные статьи и советы 📒\n"
+    "✨ Геймификация — совершенствуйся и получай призы 🎮\n"
+    "✨ Узнать свои КОСы и молнии: /cos ⚖️\n"
+    "✨ Отзывы и предложения: /yummy ✍️\n"
+    "✨ Команды для отчетов: /breakfast /lunch /dinner 🥨\n"
+    "✨ Не забудь включить уведомления для сообщений 🔔"
+)
+WELCOME_ADMIN_HINT = "\n✨ Памятка по админским командам здесь /admin 🛠"
+
+# Объекты клавиатуры PTB неизменяемы, поэтому готовое меню безопасно отдавать всем пользователям сегмента.
+# Сегмент определяется только ссылкой на CRM команды и признаком админа.
+@lru_cache(maxsize=1)
+def _static_menu_rows():
+    from telegram import InlineKeyboardButton, WebAppInfo
+    return (
+        (InlineKeyboardButton("Дашборд", web_app=WebAppInfo(url=URL_DASHBOARD)),),
+        (InlineKeyboardButton("Отработка возражений", web_app=WebAppInfo(url=URL_ALMANAC)),),
+        (InlineKeyboardButton("База знаний", url=URL_KNOWLEDGE_BASE),),
+        (InlineKeyboardButton("Геймификация (в разработке)", web_app=WebAppInfo(url=URL_GAMIFICATION)),),
+    )
+
+@lru_cache(maxsize=256)
+def _build_menu(crm_url, is_admin):
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+    keyboard_layout = ((InlineKeyboardButton("CRM", url=crm_url),),) if crm_url else ()
+    reply_markup = InlineKeyboardMarkup(keyboard_layout + _static_menu_rows())
+    return (WELCOME_TEXT + WELCOME_ADMIN_HINT if is_admin else WELCOME_TEXT), reply_markup
+
 async def send_welcome_message_with_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     chat_id = update.effective_chat.id
-    keyboard_layout = []
-    
+    crm_url, is_admin = None, False
     try:
-        response = supabase.table('persinfo').select(PERSINFO_TABLE_URL_COLUMN).eq(PERSINFO_TABLE_TG_USERNAME_COLUMN, user.username).execute()
-        if response.data:
-            crm_url = response.data[0].get(PERSINFO_TABLE_URL_COLUMN)
-            if crm_url:
-                keyboard_layout.append([InlineKeyboardButton("CRM", url=crm_url)])
+        data = await profile_cache.get(user.username)
+        if data:
+            crm_url = data.get(PERSINFO_TABLE_URL_COLUMN)
     except Exception as e:
         logger.error(f"Не удалось сформировать кнопку CRM для {user.username}: {e}")
-        
-    keyboard_layout.extend([
-        [InlineKeyboardButton("Дашборд", web_app=WebAppInfo(url=URL_DASHBOARD))],
-        [InlineKeyboardButton("Отработка возражений", web_app=WebAppInfo(url=URL_ALMANAC))],
-        [InlineKeyboardButton("База знаний", url=URL_KNOWLEDGE_BASE)],
-        [InlineKeyboardButton("Геймификация (в разработке)", web_app=WebAppInfo(url=URL_GAMIFICATION))]
-    ])
-    reply_markup = InlineKeyboardMarkup(keyboard_layout)
-    
-    welcome_text = (
-        "Твой персональный Консьерж на связи. 🤵\n\n"
-        "Выбирай, что хочешь узнать или сделать:\n\n"
-        "✨ CRM - ссылка на CRM вашей команды 💼\n"
-        "✨ Дашборд — вся важная информация у тебя под рукой 📊\n"
-        "✨ Отработка возражений — шаблоны и рекомендации ⛔️\n"
-        "✨ База знаний — полезные статьи и советы 📒\n"
-        "✨ Геймификация — совершенствуйся и получай призы 🎮\n"
-        "✨ Узнать свои КОСы и молнии: /cos ⚖️\n"
-        "✨ Отзывы и предложения: /yummy ✍️\n"
-        "✨ Команды для отчетов: /breakfast /lunch /dinner 🥨\n"
-        "✨ Не забудь включить уведомления для сообщений 🔔"
-    )
     try:
-        response = supabase.table('persinfo').select(PERSINFO_TABLE_DOLG_COLUMN).eq(PERSINFO_TABLE_TG_USERNAME_COLUMN, user.username).execute()
-        if response.data and response.data[0].get(PERSINFO_TABLE_DOLG_COLUMN) == "Админ":
-            welcome_text += "\n✨ Памятка по админским командам здесь /admin 🛠"
+        await role_registry.ensure_loaded()
+        is_admin = role_registry.has_role(user.username, ROLE_ADMIN)
     except Exception as e:
         logger.warning(f"Не удалось проверить роль для пользователя {user.username}: {e}")
+    welcome_text, reply_markup = _build_menu(crm_url, is_admin)
     await context.bot.send_message(chat_id=chat_id, text=welcome_text, reply_markup=reply_markup)
 
 async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await send_welcome_message_with_menu(update, context)
 
-async def breakfast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user = update.effective_user
-    if not user.username:
-        await update.message.reply_text("Не могу найти ваш username, пожалуйста, установите его в настройках Telegram.")
-        return
-    try:
-        response = supabase.table('persinfo').select(f"{PERSINFO_TABLE_FULL_NAME_COLUMN}, {PERSINFO_TABLE_TEAM_COLUMN}, {PERSINFO_TABLE_RGTM_COLUMN}, {PERSINFO_TABLE_TEAMLEAD_COLUMN}, {PERSINFO_TABLE_PLAN_LID_COLUMN}").eq(PERSINFO_TABLE_TG_USERNAME_COLUMN, user.username).execute()
-        if not response.data:
-            await update.message.reply_text("Не удалось найти ваши данные в базе сотрудников.")
-            return
-        data = response.data[0]
-        current_date = datetime.now().strftime("%d.%m.%Y")
-        plan_lid = data.get(PERSINFO_TABLE_PLAN_LID_COLUMN, 0)
-        operator_name = data.get(PERSINFO_TABLE_FULL_NAME_COLUMN, "ИмяФамилия")
-        hashtag_name = operator_name.replace(" ", "")
-        team = data.get(PERSINFO_TABLE_TEAM_COLUMN, "Команда")
-        rgtm = data.get(PERSINFO_TABLE_RGTM_COLUMN, "логин_ргтм")
-        teamlid = data.get(PERSINFO_TABLE_TEAMLEAD_COLUMN, "логин_тимлида")
-        breakfast_text = (
-            f"ПЛАН {current_date}\n\n"
-            f"Лиды: {plan_lid}\n"
-            "Трафик: 03:00:00\n"
-            "КЗ: 300\n\n"
-            f"#{hashtag_name}\n"
-            f"#{team}\n"
-            f"@{rgtm}\n"
-            f"@{teamlid}"
-        )
-        await update.message.reply_text(breakfast_text, parse_mode='HTML')
-    except Exception as e:
-        logger.error(f"Ошибка в /breakfast для {user.username}: {e}")
-        await update.message.reply_text("Произошла ошибка при формировании отчета.")
+# Целевые задержки отчётов (от получения команды до отправки ответа), проверяются командой /latency
+# по тем же гистограммам обработчиков, что отдаёт /metrics
+REPORT_P50_TARGET_MS = float(os.environ.get('REPORT_P50_TARGET_MS', '150'))
+REPORT_P95_TARGET_MS = float(os.environ.get('REPORT_P95_TARGET_MS', '500'))
 
-async def lunch(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+def _plan_body(p_data, t_data):
+    return (
+        f"Лиды: {p_data.get(PERSINFO_TABLE_PLAN_LID_COLUMN, 0)}\n"
+        "Трафик: 03:00:00\n"
+        "КЗ: 300\n\n"
+    )
+
+def _day_stats_body(p_data, t_data):
+    return (
+        f"Лиды: {t_data.get(TMDAY_TABLE_LID_COLUMN, 0)}\n"
+        f"Трафик: {t_data.get(TMDAY_TABLE_TRAFIC_COLUMN, '00:00:00')}\n"
+        f"КЗ: {t_data.get(TMDAY_TABLE_KZ_COLUMN, 0)}\n\n"
+    )
+
+def _final_body(p_data, t_data):
+    return _day_stats_body(p_data, t_data) + "Время прихода: 08:30\nВремя ухода: 18:00\n\n"
+
+# команда -> (заголовок, нужна ли статистика из 'TMday', тело отчёта, ответ пользователю без username)
+REPORTS = {
+    'breakfast': ("ПЛАН", False, _plan_body, "Не могу найти ваш username, пожалуйста, установите его в настройках Telegram."),
+    'lunch': ("ПРЕДВАРИТЕЛЬНЫЙ ОТЧЁТ", True, _day_stats_body, "Не могу найти ваш username."),
+    'dinner': ("ИТОГОВЫЙ ОТЧЁТ", True, _final_body, "Не могу найти ваш username."),
+}
+
+async def _send_report(update: Update, report_name: str) -> None:
+    title, needs_day_stats, build_body, no_username_text = REPORTS[report_name]
     user = update.effective_user
     if not user.username:
-        await update.message.reply_text("Не могу найти ваш username.")
+        await update.message.reply_text(no_username_text)
         return
     try:
-        persinfo_response = supabase.table('persinfo').select(f"{PERSINFO_TABLE_FULL_NAME_COLUMN}, {PERSINFO_TABLE_TEAM_COLUMN}, {PERSINFO_TABLE_RGTM_COLUMN}, {PERSINFO_TABLE_TEAMLEAD_COLUMN}").eq(PERSINFO_TABLE_TG_USERNAME_COLUMN, user.username).execute()
-        tmday_response = supabase.table('TMday').select(f"{TMDAY_TABLE_LID_COLUMN}, {TMDAY_TABLE_TRAFIC_COLUMN}, {TMDAY_TABLE_KZ_COLUMN}").eq(TMDAY_TABLE_TG_USERNAME_COLUMN, user.username).execute()
-        if not persinfo_response.data or not tmday_response.data:
-            await update.message.reply_text("Не удалось найти все необходимые данные для отчета.")
-            return
-        p_data = persinfo_response.data[0]
-        t_data = tmday_response.data[0]
+        # Профиль и дневная статистика независимы, поэтому запрашиваются одновременно
+        if needs_day_stats:
+            p_data, t_data = await asyncio.gather(profile_cache.get(user.username), tmday_snapshot.get(user.username))
+            if not p_data or not t_data:
+                await update.message.reply_text("Не удалось найти все необходимые данные для отчета.")
+                return
+        else:
+            p_data, t_data = await profile_cache.get(user.username), None
+            if not p_data:
+                await update.message.reply_text("Не удалось найти ваши данные в базе сотрудников.")
+                return
         current_date = datetime.now().strftime("%d.%m.%Y")
-        lid = t_data.get(TMDAY_TABLE_LID_COLUMN, 0)
-        trafic = t_data.get(TMDAY_TABLE_TRAFIC_COLUMN, "00:00:00")
-        kz = t_data.get(TMDAY_TABLE_KZ_COLUMN, 0)
         operator_name = p_data.get(PERSINFO_TABLE_FULL_NAME_COLUMN, "ИмяФамилия")
         hashtag_name = operator_name.replace(" ", "")
         team = p_data.get(PERSINFO_TABLE_TEAM_COLUMN, "Команда")
         rgtm = p_data.get(PERSINFO_TABLE_RGTM_COLUMN, "логин_ргтм")
         teamlid = p_data.get(PERSINFO_TABLE_TEAMLEAD_COLUMN, "логин_тимлида")
-        lunch_text = (
-            f"ПРЕДВАРИТЕЛЬНЫЙ ОТЧЁТ {current_date}\n\n"
-            f"Лиды: {lid}\n"
-            f"Трафик: {trafic}\n"
-            f"КЗ: {kz}\n\n"
+        report_text = (
+            f"{title} {current_date}\n\n"
+            f"{build_body(p_data, t_data)}"
             f"#{hashtag_name}\n"
             f"#{team}\n"
             f"@{rgtm}\n"
             f"@{teamlid}"
         )
-        await update.message.reply_text(lunch_text, parse_mode='HTML')
+        await update.message.reply_text(report_text, parse_mode='HTML')
     except Exception as e:
-        logger.error(f"Ошибка в /lunch для {user.username}: {e}")
+        count_handler_error()
+        logger.error(f"Ошибка в /{report_name} для {user.username}: {e}")
         await update.message.reply_text("Произошла ошибка при формировании отчета.")
 
+async def breakfast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await _send_report(update, 'breakfast')
+
+async def lunch(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await _send_report(update, 'lunch')
+
 async def dinner(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user = update.effective_user
-    if not user.username:
-        await update.message.reply_text("Не могу найти ваш username.")
-        return
-    try:
-        persinfo_response = supabase.table('persinfo').select(f"{PERSINFO_TABLE_FULL_NAME_COLUMN}, {PERSINFO_TABLE_TEAM_COLUMN}, {PERSINFO_TABLE_RGTM_COLUMN}, {PERSINFO_TABLE_TEAMLEAD_COLUMN}").eq(PERSINFO_TABLE_TG_USERNAME_COLUMN, user.username).execute()
-        tmday_response = supabase.table('TMday').select(f"{TMDAY_TABLE_LID_COLUMN}, {TMDAY_TABLE_TRAFIC_COLUMN}, {TMDAY_TABLE_KZ_COLUMN}").eq(TMDAY_TABLE_TG_USERNAME_COLUMN, user.username).execute()
-        if not persinfo_response.data or not tmday_response.data:
-            await update.message.reply_text("Не удалось найти все необходимые данные для отчета.")
-            return
-        p_data = persinfo_response.data[0]
-        t_data = tmday_response.data[0]
-        current_date = datetime.now().strftime("%d.%m.%Y")
-        lid = t_data.get(TMDAY_TABLE_LID_COLUMN, 0)
-        trafic = t_data.get(TMDAY_TABLE_TRAFIC_COLUMN, "00:00:00")
-        kz = t_data.get(TMDAY_TABLE_KZ_COLUMN, 0)
-        operator_name = p_data.get(PERSINFO_TABLE_FULL_NAME_COLUMN, "ИмяФамилия")
-        hashtag_name = operator_name.replace(" ", "")
-        team = p_data.get(PERSINFO_TABLE_TEAM_COLUMN, "Команда")
-        rgtm = p_data.get(PERSINFO_TABLE_RGTM_COLUMN, "логин_ргтм")
-        teamlid = p_data.get(PERSINFO_TABLE_TEAMLEAD_COLUMN, "логин_тимлида")
-        dinner_text = (
-            f"ИТОГОВЫЙ ОТЧЁТ {current_date}\n\n"
-            f"Лиды: {lid}\n"
-            f"Трафик: {trafic}\n"
-            f"КЗ: {kz}\n\n"
-            "Время прихода: 08:30\n"
-            "Время ухода: 18:00\n\n"
-            f"#{hashtag_name}\n"
-            f"#{team}\n"
-            f"@{rgtm}\n"
-            f"@{teamlid}"
-        )
-        await update.message.reply_text(dinner_text, parse_mode='HTML')
-    except Exception as e:
-        logger.error(f"Ошибка в /dinner для {user.username}: {e}")
-        await update.message.reply_text("Произошла ошибка при формировании отчета.")
+    await _send_report(update, 'dinner')
 
 async def yummy(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     text = f'Вы можете передать пожелания шеф-повару по <a href="{URL_YUMMY_FORM}">ссылке</a> 📋'
@@ -275,51 +1051,403 @@ async def cos(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text("Не могу найти ваш username.")
         return
     try:
-        response = supabase.table('TMmonth').select(f"{TMMONTH_TABLE_COS_COLUMN}, {TMMONTH_TABLE_MOLNII_COLUMN}").eq(TMMONTH_TABLE_TG_USERNAME_COLUMN, user.username).execute()
-        if not response.data:
+        data = await tmmonth_snapshot.get(user.username)
+        if not data:
             await update.message.reply_text("К сожалению, не нашел ваших данных по КОСам и молниям за этот месяц.")
             return
-        data = response.data[0]
         cos_count = data.get(TMMONTH_TABLE_COS_COLUMN, 0)
         molnii_count = data.get(TMMONTH_TABLE_MOLNII_COLUMN, 0)
         text = f"У вас {cos_count} косов 👎 и {molnii_count} молний ⚡️"
         await update.message.reply_text(text)
     except Exception as e:
+        count_handler_error()
         logger.error(f"Ошибка в /cos для {user.username}: {e}")
         await update.message.reply_text("Произошла ошибка при получении данных.")
 
-# --- БЛОК 6: АДМИНИСТРАТОРСКИЕ ФУНКЦИИ ---
+# --- БЛОК 13: ДВИЖОК РАССЫЛОК ---
+# Лимиты Telegram: ~30 сообщений в секунду на бота и не чаще одного сообщения в секунду в один чат.
+BROADCAST_WORKERS = int(os.environ.get('BROADCAST_WORKERS', '8'))
+BROADCAST_GLOBAL_RATE = float(os.environ.get('BROADCAST_GLOBAL_RATE', '25'))
+BROADCAST_PER_CHAT_INTERVAL = float(os.environ.get('BROADCAST_PER_CHAT_INTERVAL', '1'))
+BROADCAST_MAX_RETRIES = int(os.environ.get('BROADCAST_MAX_RETRIES', '3'))
+BROADCAST_RETRY_BASE_DELAY = float(os.environ.get('BROADCAST_RETRY_BASE_DELAY', '1'))
+BROADCAST_DB_PATH = os.environ.get('BROADCAST_DB_PATH', 'broadcasts.sqlite3')
+BROADCAST_CHECKPOINT_SIZE = int(os.environ.get('BROADCAST_CHECKPOINT_SIZE', '50'))
+
+class TokenBucket:
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        # RetryAfter от Telegram касается всего бота, поэтому останавливаем всех воркеров сразу
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class ChatThrottle:
+    def __init__(self, interval):
+        self.interval = interval
+        self.next_allowed = {}
+
+    async def wait(self, chat_id):
+        now = time.monotonic()
+        if len(self.next_allowed) > 10000:
+            self.next_allowed = {k: v for k, v in self.next_allowed.items() if v > now}
+        allowed_at = max(self.next_allowed.get(chat_id, now), now)
+        self.next_allowed[chat_id] = allowed_at + self.interval
+        if allowed_at > now:
+            await asyncio.sleep(allowed_at - now)
+
+# При нескольких процессах все рассылки идут в процессе 0 (см. _start_broadcast), поэтому
+# локального ведра хватает, чтобы держать общий лимит бота, и каждая рассылка идёт на полной скорости
+broadcast_bucket = TokenBucket(BROADCAST_GLOBAL_RATE)
+broadcast_chat_throttle = ChatThrottle(BROADCAST_PER_CHAT_INTERVAL)
+
+def _retry_after_seconds(error):
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+
+async def _send_with_retries(bot, chat_id, message_text):
+    from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+    for attempt in range(BROADCAST_MAX_RETRIES + 1):
+        await broadcast_chat_throttle.wait(chat_id)
+        await broadcast_bucket.acquire()
+        try:
+            await bot.send_message(chat_id=chat_id, text=message_text)
+            return
+        except RetryAfter as e:
+            if attempt == BROADCAST_MAX_RETRIES:
+                raise
+            delay = _retry_after_seconds(e)
+            logger.warning(f"Telegram просит подождать {delay} с. перед следующей отправкой.")
+            broadcast_bucket.pause(delay)
+        except (BadRequest, Forbidden):
+            raise
+        except NetworkError as e:
+            if attempt == BROADCAST_MAX_RETRIES:
+                raise
+            delay = BROADCAST_RETRY_BASE_DELAY * 2 ** attempt
+            logger.warning(f"Сетевая ошибка при отправке пользователю {chat_id}, повтор через {delay} с.: {e}")
+            await asyncio.sleep(delay)
+
+# Задачи рассылок и состояние каждого получателя хранятся в локальном SQLite: после перезапуска
+# незавершённая рассылка продолжается с места остановки. Состояние пишется пачками, поэтому
+# при падении повторно могут уйти не больше BROADCAST_CHECKPOINT_SIZE сообщений на воркер.
+BROADCAST_SCHEMA = """
+CREATE TABLE IF NOT EXISTS broadcast_jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    admin_chat_id INTEGER NOT NULL,
+    message_text TEXT NOT NULL,
+    done_text TEXT NOT NULL,
+    status TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE TABLE IF NOT EXISTS broadcast_recipients (
+    job_id INTEGER NOT NULL,
+    tg_id INTEGER NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    error_class TEXT,
+    PRIMARY KEY (job_id, tg_id)
+);
+CREATE TABLE IF NOT EXISTS blocked_users (
+    tg_id INTEGER PRIMARY KEY,
+    error_class TEXT NOT NULL,
+    blocked_at REAL NOT NULL
+);
+"""
+
+class BroadcastStore:
+    def __init__(self, path):
+        self.path = path
+        self.connection = None
+        self.lock = threading.Lock()
+        # Копия 'blocked_users' в памяти для быстрой проверки в /start. SQLite общий для всех
+        # процессов-обработчиков, поэтому каждый загружает её при прогреве, а изменения
+        # рассылает соседям через notify_workers
+        self.blocked_ids = set()
+
+    async def call(self, method, *args):
+        # sqlite3 синхронный, поэтому запросы уходят в поток, чтобы не держать event loop
+        return await asyncio.to_thread(self._locked, method, *args)
+
+    def _locked(self, method, *args):
+        with self.lock:
+            if self.connection is None:
+                self.connection = sqlite3.connect(self.path, check_same_thread=False)
+                self.connection.execute("PRAGMA journal_mode=WAL")
+                self.connection.executescript(BROADCAST_SCHEMA)
+            with self.connection:
+                return method(self.connection, *args)
+
+    def load_blocked(self, connection):
+        self.blocked_ids = set(self.blocked_users(connection))
+
+    def create_job(self, connection, admin_chat_id, message_text, done_text, target_ids):
+        # Фильтр по самой таблице, а не по копии в памяти: блокировку мог записать другой процесс
+        blocked_ids = set(self.blocked_users(connection))
+        recipients = [tg_id for tg_id in dict.fromkeys(target_ids) if tg_id not in blocked_ids]
+        cursor = connection.execute(
+            "INSERT INTO broadcast_jobs (admin_chat_id, message_text, done_text, status, total, created_at) VALUES (?, ?, ?, 'running', ?, ?)",
+            (admin_chat_id, message_text, done_text, len(recipients), time.time()),
+        )
+        connection.executemany("INSERT INTO broadcast_recipients (job_id, tg_id) VALUES (?, ?)", [(cursor.lastrowid, tg_id) for tg_id in recipients])
+        return cursor.lastrowid, recipients
+
+    def checkpoint(self, connection, job_id, results):
+        connection.executemany(
+            "UPDATE broadcast_recipients SET state = ?, error_class = ? WHERE job_id = ? AND tg_id = ?",
+            [(state, error_class, job_id, tg_id) for tg_id, state, error_class in results],
+        )
+        blocked = [(tg_id, error_class, time.time()) for tg_id, state, error_class in results if error_class == 'Forbidden']
+        connection.executemany("INSERT OR REPLACE INTO blocked_users (tg_id, error_class, blocked_at) VALUES (?, ?, ?)", blocked)
+        blocked_ids = [tg_id for tg_id, _, _ in blocked]
+        self.blocked_ids.update(blocked_ids)
+        return blocked_ids
+
+    def finish_job(self, connection, job_id, status):
+        connection.execute("UPDATE broadcast_jobs SET status = ?, finished_at = ? WHERE id = ? AND status = 'running'", (status, time.time(), job_id))
+
+    def unfinished_jobs(self, connection, job_id=None):
+        query = "SELECT id, admin_chat_id, message_text, done_text, total FROM broadcast_jobs WHERE status = 'running'"
+        jobs = connection.execute(query + " AND id = ?", (job_id,)).fetchall() if job_id is not None else connection.execute(query).fetchall()
+        return [
+            (job, [row[0] for row in connection.execute("SELECT tg_id FROM broadcast_recipients WHERE job_id = ? AND state = 'pending'", (job[0],))])
+            for job in jobs
+        ]
+
+    def job_summary(self, connection, job_id):
+        job = connection.execute("SELECT id, status, total, created_at, finished_at FROM broadcast_jobs WHERE id = ?", (job_id,)).fetchone()
+        if job is None:
+            return None
+        states = dict(connection.execute("SELECT state, COUNT(*) FROM broadcast_recipients WHERE job_id = ? GROUP BY state", (job_id,)).fetchall())
+        errors = connection.execute(
+            "SELECT error_class, COUNT(*) FROM broadcast_recipients WHERE job_id = ? AND state = 'failed' GROUP BY error_class", (job_id,)
+        ).fetchall()
+        return job, states, errors
+
+    def recent_jobs(self, connection, limit):
+        return connection.execute("SELECT id, status, total, created_at FROM broadcast_jobs ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+
+    def blocked_users(self, connection):
+        return [row[0] for row in connection.execute("SELECT tg_id FROM blocked_users")]
+
+    def forget_blocked(self, connection, tg_ids):
+        connection.executemany("DELETE FROM blocked_users WHERE tg_id = ?", [(tg_id,) for tg_id in tg_ids])
+        self.blocked_ids.difference_update(tg_ids)
+
+broadcast_store = BroadcastStore(BROADCAST_DB_PATH)
+
+class BroadcastRun:
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.sent = 0
+        self.failed = 0
+        self.started_at = time.monotonic()
+        self.cancelled = False
+        # Остановка бота, в отличие от отмены, оставляет задачу незавершённой для продолжения после запуска
+        self.stopping = False
+        self.results = []
+        self.task = None
+
+    def throughput(self):
+        elapsed = time.monotonic() - self.started_at
+        return (self.sent + self.failed) / elapsed if elapsed > 0 else 0.0
+
+active_broadcasts = {}
+
+async def _checkpoint(run, force=False):
+    if run.results and (force or len(run.results) >= BROADCAST_CHECKPOINT_SIZE):
+        results, run.results = run.results, []
+        try:
+            blocked_ids = await broadcast_store.call(broadcast_store.checkpoint, run.job_id, results)
+        except Exception:
+            # Результаты не теряем: их запишет следующая, в том числе финальная, контрольная точка
+            run.results[:0] = results
+            raise
+        if blocked_ids:
+            notify_workers('block_users', blocked_ids)
+
+async def _do_broadcast(run, target_ids, message_text, bot):
+    pending_ids = iter(target_ids)
+
+    async def worker():
+        for user_id in pending_ids:
+            if run.cancelled or run.stopping:
+                return
+            try:
+                await _send_with_retries(bot, user_id, message_text)
+                run.sent += 1
+                run.results.append((user_id, 'sent', None))
+            except Exception as e:
+                logger.error(f"Не удалось отправить сообщение пользователю {user_id}: {e}")
+                run.failed += 1
+                run.results.append((user_id, 'failed', type(e).__name__))
+            await _checkpoint(run)
+
+    workers = [asyncio.create_task(worker()) for _ in range(max(1, min(BROADCAST_WORKERS, len(target_ids))))]
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        # Если один воркер упал (например, SQLite занят), остальные не должны рассылать дальше
+        # без учёта и без возможности отменить их через /broadcast_cancel
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        await _checkpoint(run, force=True)
+
+def _launch_broadcast(application, job_id, admin_chat_id, message_text, done_text, total, pending_ids):
+    if job_id in active_broadcasts:
+        # Задачу уже подхватило продолжение после перезапуска процесса
+        return
+    run = BroadcastRun(job_id)
+    active_broadcasts[job_id] = run
+
+    async def execute():
+        try:
+            await _do_broadcast(run, pending_ids, message_text, application.bot)
+            if run.stopping and not run.cancelled:
+                logger.info(f"Рассылка #{job_id} прервана остановкой бота и продолжится после запуска.")
+                return
+            await broadcast_store.call(broadcast_store.finish_job, job_id, 'cancelled' if run.cancelled else 'done')
+            summary = await broadcast_store.call(broadcast_store.job_summary, job_id)
+            states = summary[1]
+            if run.cancelled:
+                text = f"⛔️ Рассылка #{job_id} отменена. Отправлено: {states.get('sent', 0)}/{total}"
+            else:
+                text = f"{done_text} Отправлено: {states.get('sent', 0)}/{total}"
+                if states.get('failed'):
+                    text += f", ошибок: {states['failed']} (подробно: /broadcast_status {job_id})"
+            # Итог идёт через те же лимиты: админ обычно сам в списке получателей
+            await _send_with_retries(application.bot, admin_chat_id, text)
+        except Exception as e:
+            logger.error(f"Ошибка фоновой рассылки #{job_id}: {e}")
+            try:
+                await application.bot.send_message(chat_id=admin_chat_id, text=f"Ошибка при рассылке #{job_id}: {e}")
+            except Exception as notify_error:
+                logger.error(f"Не удалось сообщить администратору об ошибке рассылки #{job_id}: {notify_error}")
+        finally:
+            active_broadcasts.pop(job_id, None)
+
+    # Не application.create_task: Application.stop() дожидается таких задач целиком, и остановка
+    # бота ждала бы конца рассылки. Свою задачу останавливает stop_broadcasts() из post_stop
+    run.task = _spawn_background(execute())
+
+async def stop_broadcasts():
+    runs = list(active_broadcasts.values())
+    for run in runs:
+        run.stopping = True
+    # Воркеры дописывают текущую отправку, _do_broadcast сохраняет результаты, задача остаётся 'running'
+    await asyncio.gather(*(run.task for run in runs), return_exceptions=True)
+
+async def _start_broadcast(update, context, target_ids, message_text, done_text):
+    # Рассылка идёт в фоне: админ-команда возвращается сразу, бот продолжает отвечать остальным
+    admin_chat_id = update.effective_chat.id
+    job_id, recipients = await broadcast_store.call(broadcast_store.create_job, admin_chat_id, message_text, done_text, target_ids)
+    if WORKER_INDEX == 0:
+        _launch_broadcast(context.application, job_id, admin_chat_id, message_text, done_text, len(recipients), recipients)
+    else:
+        # Задача уже лежит в общем SQLite, процесс 0 прочитает её оттуда
+        send_to_worker(0, 'run_broadcast', job_id)
+    # Заблокировавшие бота уже отброшены, поэтому админу сообщаем число настоящих получателей
+    return job_id, len(recipients)
+
+async def run_unfinished_broadcasts(application, job_id=None):
+    unfinished = await broadcast_store.call(broadcast_store.unfinished_jobs, job_id)
+    for (job_id, admin_chat_id, message_text, done_text, total), pending_ids in unfinished:
+        if len(pending_ids) != total:
+            logger.info(f"Продолжаю рассылку #{job_id}: осталось {len(pending_ids)} из {total} получателей.")
+        _launch_broadcast(application, job_id, admin_chat_id, message_text, done_text, total, pending_ids)
+
+async def resume_broadcasts_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        await run_unfinished_broadcasts(context.application)
+    except Exception as e:
+        logger.error(f"Не удалось прочитать незавершённые рассылки: {e}")
+
+# --- БЛОК 14: АДМИНИСТРАТОРСКИЕ ФУНКЦИИ ---
 @admin_only
 async def admin_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     admin_text = (
         "Команды администратора:\n"
-        "/stats - количество людей в БД\n"
+        "/stats - количество людей в БД с разбивкой по командам, городам и должностям\n"
         "/broadcast <текст> - отправить сообщение всем в БД\n"
         "/broadcast_team <команда> <текст> - отправить сообщение всей указанной команде\n"
         "/broadcast_city <город> <текст> - отправить сообщение всем в указанном городе\n"
-        "/broadcast_dolg <должность> <текст> - отправить сообщение всем указанной должности"
+        "/broadcast_dolg <должность> <текст> - отправить сообщение всем указанной должности\n"
+        "/broadcast_filter team=<команда> city=<город> <текст> - рассылка по нескольким условиям сразу\n"
+        "/broadcast_status [номер] - прогресс и ошибки рассылки (без номера - последние рассылки)\n"
+        "/broadcast_cancel <номер> - остановить рассылку\n"
+        "/prune_blocked - удалить из БД пользователей, заблокировавших бота\n"
+        "/reload_urls - перечитать ссылки меню из файла без перезапуска\n"
+        "/perf - задержки и ошибки обработчиков, запросов к Supabase и лаг event loop\n"
+        "/latency - задержка отчётов /breakfast /lunch /dinner относительно цели\n"
+        "/cache_reset [логин] - сбросить кэш профиля сотрудника (без логина - весь кэш) и перечитать роли"
     )
     await update.message.reply_text(admin_text)
 
+STATS_CACHE_TTL = float(os.environ.get('STATS_CACHE_TTL', '30'))
+STATS_BREAKDOWN_LIMIT = int(os.environ.get('STATS_BREAKDOWN_LIMIT', '10'))
+STATS_BREAKDOWN_TITLES = (
+    (PERSINFO_TABLE_TEAM_COLUMN, "По командам"),
+    (PERSINFO_TABLE_CITY_COLUMN, "По городам"),
+    (PERSINFO_TABLE_DOLG_COLUMN, "По должностям"),
+)
+stats_cache = make_cache_backend('stats')
+
+async def _cached_users_count():
+    users_count = await stats_cache.get('users_count')
+    if users_count is None:
+        users_count = await db_count_users()
+        await stats_cache.set('users_count', users_count, STATS_CACHE_TTL)
+    return users_count
+
 @admin_only
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     try:
-        response = supabase.table('users').select('*', count='exact').execute()
-        await update.message.reply_text(f"📊 Всего пользователей в базе данных: {response.count}")
+        users_count = await _cached_users_count()
+        lines = [f"📊 Всего пользователей в базе данных: {users_count}"]
+        # Разбивка считается по справочнику в памяти: только сотрудники, которые запускали бота
+        if not directory.loaded_at:
+            try:
+                await directory.refresh()
+            except Exception as e:
+                # Общее число уже получено, поэтому без справочника отвечаем хотя бы им
+                logger.warning(f"Не удалось загрузить справочник для /stats: {e}")
+        if directory.loaded_at:
+            for column, title in STATS_BREAKDOWN_TITLES:
+                counts, groups_total = directory.breakdown(column, STATS_BREAKDOWN_LIMIT)
+                if not counts:
+                    continue
+                tail = f" и ещё {groups_total - len(counts)}" if groups_total > len(counts) else ""
+                lines.append(f"\n{title}: " + ", ".join(f"{value} — {count}" for value, count in counts) + tail)
+            lines.append(f"\nСправочник обновлён: {directory.loaded_at.strftime('%H:%M:%S')}")
+        else:
+            lines.append("\nРазбивка недоступна: справочник сотрудников не загрузился, попробуйте позже.")
+        lines.append(registration_queue.stats_text())
+        await update.message.reply_text("\n".join(lines))
     except Exception as e:
+        count_handler_error()
         await update.message.reply_text(f"Ошибка при получении статистики: {e}")
 
-async def _do_broadcast(target_ids, message_text, update, context):
-    sent_count = 0
-    for user_id in target_ids:
-        try:
-            await context.bot.send_message(chat_id=user_id, text=message_text)
-            sent_count += 1
-            time.sleep(0.1)
-        except Exception as e:
-            logger.error(f"Не удалось отправить сообщение пользователю {user_id}: {e}")
-    return sent_count
-
 @admin_only
 async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     message_text = " ".join(context.args)
@@ -327,21 +1455,81 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text("Использование: /broadcast <текст для всех>")
         return
     try:
-        response = supabase.table('users').select(USERS_TABLE_TG_ID_COLUMN).execute()
-        user_ids = [user[USERS_TABLE_TG_ID_COLUMN] for user in response.data]
-        await update.message.reply_text(f"Начинаю рассылку для {len(user_ids)} пользователей...")
-        sent_count = await _do_broadcast(user_ids, message_text, update, context)
-        await update.message.reply_text(f"✅ Рассылка завершена. Отправлено: {sent_count}/{len(user_ids)}")
+        user_ids = await db_get_all_user_ids()
+        job_id, recipients_count = await _start_broadcast(update, context, user_ids, message_text, "✅ Рассылка завершена.")
+        await update.message.reply_text(f"Начинаю рассылку для {recipients_count} пользователей... Задача #{job_id}, прогресс: /broadcast_status {job_id}")
     except Exception as e:
+        count_handler_error()
         await update.message.reply_text(f"Ошибка при рассылке: {e}")
 
+@admin_only
+async def latency(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    lines = [f"⏱ Задержка отчётов (цель: p50 ≤ {REPORT_P50_TARGET_MS:.0f} мс, p95 ≤ {REPORT_P95_TARGET_MS:.0f} мс)"]
+    for report_name in REPORTS:
+        histogram = metrics.handler_latency.get(f"/{report_name}")
+        if not histogram:
+            lines.append(f"/{report_name}: нет данных")
+            continue
+        p50, p95 = histogram.percentile(50) * 1000, histogram.percentile(95) * 1000
+        mark = "✅" if p50 <= REPORT_P50_TARGET_MS and p95 <= REPORT_P95_TARGET_MS else "⚠️"
+        lines.append(f"{mark} /{report_name}: p50 {p50:.0f} мс, p95 {p95:.0f} мс (замеров: {histogram.count})")
+    await update.message.reply_text("\n".join(lines))
+
+def _perf_lines(histograms, errors):
+    lines = []
+    for name, histogram in sorted(histograms.items(), key=lambda item: -item[1].count):
+        lines.append(f"{name}: {histogram.count} / {errors[name]} / {histogram.percentile(50) * 1000:.0f} / {histogram.percentile(95) * 1000:.0f}")
+    return lines or ["нет данных"]
+
+@admin_only
+async def perf(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    lines = [f"⚙️ Процесс-обработчик {WORKER_INDEX + 1} из {BOT_WORKERS}\n"] if BOT_WORKERS > 1 else []
+    lines.append("📈 Обработчики (вызовы / ошибки / p50 / p95, мс):")
+    lines += _perf_lines(metrics.handler_latency, metrics.handler_errors)
+    lines.append("\n🗄 Supabase по таблицам (вызовы / ошибки / p50 / p95, мс):")
+    lines += _perf_lines(metrics.db_latency, metrics.db_errors)
+    lines.append(f"\n⏳ Лаг event loop: p95 {metrics.loop_lag.percentile(95) * 1000:.1f} мс, максимум {metrics.loop_lag_max * 1000:.1f} мс")
+    await update.message.reply_text("\n".join(lines))
+
+async def reset_caches(username=None):
+    if username:
+        removed = await profile_cache.invalidate(username)
+    else:
+        removed = await profile_cache.invalidate()
+        await stats_cache.delete('users_count')
+    try:
+        await role_registry.refresh()
+    except Exception as e:
+        logger.error(f"Не удалось обновить роли: {e}")
+    return removed
+
+@admin_only
+async def cache_reset(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    username = context.args[0].lstrip('@') if context.args else None
+    removed = await reset_caches(username)
+    notify_workers('cache_reset', username)
+    if username:
+        text = f"Кэш профиля @{username} сброшен." if removed else f"Профиля @{username} нет в кэше."
+    else:
+        text = f"Кэш профилей очищен, удалено записей: {removed}."
+    await update.message.reply_text(f"{text}\n{await profile_cache.stats_text()}\n{await tmday_snapshot.stats_text()}\n{await tmmonth_snapshot.stats_text()}")
+
 async def _get_users_by_filter(filter_column, filter_value):
-    persinfo_resp = supabase.table('persinfo').select(PERSINFO_TABLE_TG_USERNAME_COLUMN).eq(filter_column, filter_value).execute()
-    usernames = [user[PERSINFO_TABLE_TG_USERNAME_COLUMN] for user in persinfo_resp.data]
+    if directory.loaded_at:
+        user_ids = directory.select({filter_column: filter_value})
+        return None if user_ids is None else list(user_ids)
+    usernames = await db_get_usernames_by(filter_column, filter_value)
     if not usernames:
         return None
-    users_resp = supabase.table('users').select(USERS_TABLE_TG_ID_COLUMN).in_(USERS_TABLE_TG_USERNAME_COLUMN, usernames).execute()
-    return [user[USERS_TABLE_TG_ID_COLUMN] for user in users_resp.data]
+    return await db_get_user_ids_by_usernames(usernames)
+
+BROADCAST_FILTER_KEYS = {
+    'team': PERSINFO_TABLE_TEAM_COLUMN,
+    'city': PERSINFO_TABLE_CITY_COLUMN,
+    'dolg': PERSINFO_TABLE_DOLG_COLUMN,
+    'teamlid': PERSINFO_TABLE_TEAMLEAD_COLUMN,
+    'rgtm': PERSINFO_TABLE_RGTM_COLUMN,
+}
 
 @admin_only
 async def broadcast_team(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -354,10 +1542,10 @@ async def broadcast_team(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         if user_ids is None:
             await update.message.reply_text(f"Не найдено сотрудников в команде '{team_name}'.")
             return
-        await update.message.reply_text(f"Начинаю рассылку для команды '{team_name}' ({len(user_ids)} пользователей)...")
-        sent_count = await _do_broadcast(user_ids, message_text, update, context)
-        await update.message.reply_text(f"✅ Рассылка для команды '{team_name}' завершена. Отправлено: {sent_count}/{len(user_ids)}")
+        job_id, recipients_count = await _start_broadcast(update, context, user_ids, message_text, f"✅ Рассылка для команды '{team_name}' завершена.")
+        await update.message.reply_text(f"Начинаю рассылку для команды '{team_name}' ({recipients_count} пользователей)... Задача #{job_id}, прогресс: /broadcast_status {job_id}")
     except Exception as e:
+        count_handler_error()
         await update.message.reply_text(f"Ошибка при рассылке по команде: {e}")
 
 @admin_only
@@ -371,10 +1559,10 @@ async def broadcast_city(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         if user_ids is None:
             await update.message.reply_text(f"Не найдено сотрудников из города '{city_name}'.")
             return
-        await update.message.reply_text(f"Начинаю рассылку для города '{city_name}' ({len(user_ids)} пользователей)...")
-        sent_count = await _do_broadcast(user_ids, message_text, update, context)
-        await update.message.reply_text(f"✅ Рассылка для города '{city_name}' завершена. Отправлено: {sent_count}/{len(user_ids)}")
+        job_id, recipients_count = await _start_broadcast(update, context, user_ids, message_text, f"✅ Рассылка для города '{city_name}' завершена.")
+        await update.message.reply_text(f"Начинаю рассылку для города '{city_name}' ({recipients_count} пользователей)... Задача #{job_id}, прогресс: /broadcast_status {job_id}")
     except Exception as e:
+        count_handler_error()
         await update.message.reply_text(f"Ошибка при рассылке по городу: {e}")
 
 @admin_only
@@ -388,15 +1576,480 @@ async def broadcast_dolg(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         if user_ids is None:
             await update.message.reply_text(f"Не найдено сотрудников с должностью '{dolg_name}'.")
             return
-        await update.message.reply_text(f"Начинаю рассылку для должности '{dolg_name}' ({len(user_ids)} пользователей)...")
-        sent_count = await _do_broadcast(user_ids, message_text, update, context)
-        await update.message.reply_text(f"✅ Рассылка для должности '{dolg_name}' завершена. Отправлено: {sent_count}/{len(user_ids)}")
+        job_id, recipients_count = await _start_broadcast(update, context, user_ids, message_text, f"✅ Рассылка для должности '{dolg_name}' завершена.")
+        await update.message.reply_text(f"Начинаю рассылку для должности '{dolg_name}' ({recipients_count} пользователей)... Задача #{job_id}, прогресс: /broadcast_status {job_id}")
     except Exception as e:
+        count_handler_error()
         await update.message.reply_text(f"Ошибка при рассылке по должности: {e}")
 
-# --- БЛОК 7: ОСНОВНАЯ ФУНКЦИЯ ЗАПУСКА И РЕГИСТРАЦИЯ КОМАНД ---
-def main() -> None:
-    application = Application.builder().token(BOT_TOKEN).build()
+@admin_only
+async def broadcast_filter(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    criteria = {}
+    args = list(context.args)
+    while args and args[0].split("=", 1)[0] in BROADCAST_FILTER_KEYS and "=" in args[0]:
+        key, value = args.pop(0).split("=", 1)
+        criteria[BROADCAST_FILTER_KEYS[key]] = value
+    message_text = " ".join(args)
+    if not criteria or not message_text:
+        await update.message.reply_text("Использование: /broadcast_filter team=<Команда> city=<Город> dolg=<Должность> <текст>\nКритерии (team, city, dolg, teamlid, rgtm) можно комбинировать.")
+        return
+    criteria_text = ", ".join(f"{column}='{value}'" for column, value in criteria.items())
+    try:
+        if not directory.loaded_at:
+            await directory.refresh()
+        user_ids = directory.select(criteria)
+        if not user_ids:
+            await update.message.reply_text(f"Не найдено сотрудников по условиям {criteria_text}.")
+            return
+        user_ids = list(user_ids)
+        job_id, recipients_count = await _start_broadcast(update, context, user_ids, message_text, f"✅ Рассылка по условиям {criteria_text} завершена.")
+        await update.message.reply_text(f"Начинаю рассылку по условиям {criteria_text} ({recipients_count} пользователей)... Задача #{job_id}, прогресс: /broadcast_status {job_id}")
+    except Exception as e:
+        count_handler_error()
+        await update.message.reply_text(f"Ошибка при рассылке по условиям: {e}")
+
+@admin_only
+async def reload_urls_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not MENU_CONFIG_PATH:
+        await update.message.reply_text("Файл ссылок не задан: укажите MENU_CONFIG_PATH в переменных окружения.")
+        return
+    try:
+        changed = reload_urls()
+        notify_workers('reload_urls')
+        await update.message.reply_text(f"Ссылки меню перечитаны. Изменены: {', '.join(changed) or 'нет'}.")
+    except Exception as e:
+        count_handler_error()
+        await update.message.reply_text(f"Ошибка при чтении файла ссылок: {e}")
+
+BROADCAST_STATUS_TITLES = {'running': "идёт", 'done': "завершена", 'cancelled': "отменена"}
+
+def _parse_job_id(args):
+    try:
+        return int(args[0].lstrip('#')) if args else None
+    except ValueError:
+        return None
+
+@admin_only
+async def broadcast_status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        if not context.args:
+            jobs = await broadcast_store.call(broadcast_store.recent_jobs, 5)
+            if not jobs:
+                await update.message.reply_text("Рассылок ещё не было.")
+                return
+            lines = ["Последние рассылки:"]
+            for job_id, status, total, created_at in jobs:
+                lines.append(f"#{job_id} от {datetime.fromtimestamp(created_at).strftime('%d.%m %H:%M')}: {BROADCAST_STATUS_TITLES.get(status, status)}, получателей {total}")
+            lines.append("Подробно: /broadcast_status <номер>")
+            await update.message.reply_text("\n".join(lines))
+            return
+        job_id = _parse_job_id(context.args)
+        summary = await broadcast_store.call(broadcast_store.job_summary, job_id) if job_id is not None else None
+        if summary is None:
+            await update.message.reply_text("Рассылка не найдена. Использование: /broadcast_status [номер]")
+            return
+        (job_id, status, total, created_at, finished_at), states, errors = summary
+        states = Counter(states)
+        run = active_broadcasts.get(job_id)
+        if run:
+            # Результаты, ещё не записанные в SQLite, добавляем из памяти
+            for _, state, _ in run.results:
+                states[state] += 1
+                states['pending'] -= 1
+        lines = [
+            f"📬 Рассылка #{job_id}: {BROADCAST_STATUS_TITLES.get(status, status)}",
+            f"Отправлено: {states['sent']}/{total}, ошибок: {states['failed']}, в очереди: {states['pending']}",
+        ]
+        if run:
+            speed = run.throughput()
+            eta = f", осталось ~{states['pending'] / speed:.0f} с" if speed else ""
+            lines.append(f"Скорость: {speed:.1f} сообщ./с{eta}")
+        elif finished_at:
+            lines.append(f"Длительность: {finished_at - created_at:.0f} с")
+        if errors:
+            lines.append("Ошибки: " + ", ".join(f"{error_class} - {count}" for error_class, count in errors))
+        await update.message.reply_text("\n".join(lines))
+    except Exception as e:
+        count_handler_error()
+        await update.message.reply_text(f"Ошибка при получении статуса рассылки: {e}")
+
+@admin_only
+async def broadcast_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    job_id = _parse_job_id(context.args)
+    if job_id is None:
+        await update.message.reply_text("Использование: /broadcast_cancel <номер рассылки>")
+        return
+    try:
+        summary = await broadcast_store.call(broadcast_store.job_summary, job_id)
+        if summary is None or summary[0][1] != 'running':
+            await update.message.reply_text(f"Рассылка #{job_id} не найдена или уже не выполняется.")
+            return
+        run = active_broadcasts.get(job_id)
+        if run:
+            run.cancelled = True
+        else:
+            # Рассылки идут в процессе 0
+            send_to_worker(0, 'broadcast_cancel', job_id)
+        await broadcast_store.call(broadcast_store.finish_job, job_id, 'cancelled')
+        await update.message.reply_text(f"Рассылка #{job_id} отменяется. Уже отправленные сообщения останутся у получателей.")
+    except Exception as e:
+        count_handler_error()
+        await update.message.reply_text(f"Ошибка при отмене рассылки: {e}")
+
+def forget_users(tg_ids):
+    broadcast_store.blocked_ids.difference_update(tg_ids)
+    directory.discard(tg_ids)
+    for tg_id in tg_ids:
+        registration_queue.known.pop(tg_id, None)
+
+@admin_only
+async def prune_blocked(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        tg_ids = await broadcast_store.call(broadcast_store.blocked_users)
+        if not tg_ids:
+            await update.message.reply_text("Пользователей, заблокировавших бота, не найдено.")
+            return
+        await db_delete_users(tg_ids)
+        await broadcast_store.call(broadcast_store.forget_blocked, tg_ids)
+        forget_users(tg_ids)
+        notify_workers('forget_users', tg_ids)
+        await update.message.reply_text(f"Из 'users' удалено пользователей, заблокировавших бота: {len(tg_ids)}.")
+    except Exception as e:
+        count_handler_error()
+        await update.message.reply_text(f"Ошибка при очистке заблокированных пользователей: {e}")
+
+# --- БЛОК 15: РЕЖИМ WEBHOOK ---
+# Свой HTTP-сервер вместо run_webhook, чтобы рядом с приёмом апдейтов отдавать
+# проверки живости и готовности для балансировщика.
+def webhook_endpoint(submit):
+    async def receive(request):
+        secret_token = request.request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        # compare_digest не принимает str с не-ASCII символами, а заголовок может прийти любым
+        if not hmac.compare_digest(secret_token.encode(), WEBHOOK_SECRET.encode()):
+            request.set_status(403)
+            return
+        try:
+            data = json.loads(request.request.body)
+        except ValueError:
+            request.set_status(400)
+            return
+        await submit(data)
+    return receive
+
+def health_endpoint(request):
+    request.write({"status": "ok"})
+
+def readiness_endpoint(application):
+    def check(request):
+        ready = application.running
+        if not ready:
+            request.set_status(503)
+        request.write({
+            "ready": ready,
+            "directory_loaded": directory.loaded_at is not None,
+            "tmday_loaded": tmday_snapshot.loaded_at is not None,
+            "tmmonth_loaded": tmmonth_snapshot.loaded_at is not None,
+        })
+    return check
+
+def _stop_event():
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    return stop_event
+
+async def _set_webhook(bot):
+    from telegram import Update
+    await bot.set_webhook(
+        url=f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=Update.ALL_TYPES,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+    )
+
+async def _serve_application(application: Application, serve) -> None:
+    # Жизненный цикл повторяет run_polling: хуки post_init/post_stop/post_shutdown вызываются вручную
+    try:
+        async with application:
+            if application.post_init:
+                await application.post_init(application)
+            await application.start()
+            try:
+                await serve()
+            finally:
+                # Даже если serve() упал (не удалось поставить webhook, порт занят), останавливаем приложение:
+                # иначе post_stop не запишет очередь регистраций, а shutdown() скроет исходную ошибку
+                await application.stop()
+                if application.post_stop:
+                    await application.post_stop(application)
+    finally:
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+async def run_webhook(application: Application) -> None:
+    from telegram import Update
+
+    async def submit(data):
+        await application.update_queue.put(Update.de_json(data, application.bot))
+
+    server = make_http_server([
+        (WEBHOOK_PATH, {"post": webhook_endpoint(submit)}),
+        (r"/healthz", {"get": health_endpoint}),
+        (r"/readyz", {"get": readiness_endpoint(application)}),
+    ])
+    stop_event = _stop_event()
+
+    async def serve():
+        await _set_webhook(application.bot)
+        server.listen(WEBHOOK_PORT, WEBHOOK_LISTEN)
+        logger.info(f"Webhook-сервер слушает {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        await stop_event.wait()
+        server.stop()
+
+    await _serve_application(application, serve)
+
+# --- БЛОК 16: ДИСПЕТЧЕР ПРОЦЕССОВ-ОБРАБОТЧИКОВ ---
+# Один event loop упирается в одно ядро: разбор больших ответов Supabase и форматирование отчётов
+# конкурируют со всеми обработчиками. При BOT_WORKERS > 1 главный процесс только получает апдейты
+# (polling или webhook) и кладёт их в очередь процесса-обработчика, выбранного по id пользователя.
+# Все апдейты одного человека попадают в один процесс, поэтому его профиль, регистрация и порядок
+# сообщений остаются в одном месте, а кэш профилей не дублируется даже без общего бэкенда.
+# Рассылки же идут только в процессе 0: так одно ведро держит общий лимит бота на отправку.
+DISPATCHER_POLL_TIMEOUT = int(os.environ.get('DISPATCHER_POLL_TIMEOUT', '30'))
+DISPATCHER_SUPERVISE_INTERVAL = float(os.environ.get('DISPATCHER_SUPERVISE_INTERVAL', '5'))
+WORKER_INDEX = 0
+worker_queues = []
+
+def loads_stats_snapshots():
+    # С общим бэкендом кэша снимки грузит один процесс, остальные читают их из бэкенда
+    return WORKER_INDEX == 0 or CACHE_BACKEND != 'redis'
+
+def _shard_of(update):
+    source = update.effective_user or update.effective_chat
+    return source.id % BOT_WORKERS if source else 0
+
+def notify_workers(name, *args):
+    # Админ-команды меняют состояние только своего процесса, остальным отправляем то же действие
+    for index, worker_queue in enumerate(worker_queues):
+        if index != WORKER_INDEX:
+            worker_queue.put(('control', name, args))
+
+def send_to_worker(index, name, *args):
+    if worker_queues:
+        worker_queues[index].put(('control', name, args))
+
+async def _apply_control(application, name, args):
+    if name == 'cache_reset':
+        await reset_caches(*args)
+    elif name == 'reload_urls':
+        reload_urls()
+    elif name == 'broadcast_cancel':
+        run = active_broadcasts.get(args[0])
+        if run:
+            run.cancelled = True
+    elif name == 'run_broadcast':
+        await run_unfinished_broadcasts(application, *args)
+    elif name == 'forget_users':
+        forget_users(*args)
+    elif name == 'directory_add_users':
+        directory.add_users(*args)
+    elif name == 'block_users':
+        broadcast_store.blocked_ids.update(*args)
+    elif name == 'forget_blocked':
+        broadcast_store.blocked_ids.difference_update(*args)
+
+async def run_worker(application: Application) -> None:
+    from telegram import Update
+    worker_queue = worker_queues[WORKER_INDEX]
+
+    async def serve():
+        logger.info(f"Процесс-обработчик {WORKER_INDEX} запущен (pid {os.getpid()}).")
+        while True:
+            # Очередь multiprocessing блокирующая, поэтому ждём её в отдельном потоке
+            item = await asyncio.to_thread(worker_queue.get)
+            if item is None:
+                return
+            if item[0] == 'update':
+                await application.update_queue.put(Update.de_json(item[1], application.bot))
+                continue
+            try:
+                await _apply_control(application, item[1], item[2])
+            except Exception as e:
+                logger.error(f"Не удалось выполнить '{item[1]}' по запросу соседнего процесса: {e}")
+
+    await _serve_application(application, serve)
+
+def worker_main(worker_index, queues):
+    global WORKER_INDEX, worker_queues
+    WORKER_INDEX, worker_queues = worker_index, queues
+    # Ctrl+C и SIGTERM от systemd/docker получает вся группа процессов, а обработчиков останавливает
+    # диспетчер через очередь - так успевают отработать post_stop и запись незаконченного
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(run_worker(build_application()))
+
+async def _poll_updates(bot, dispatch, stop_event):
+    from telegram import Update
+    offset = None
+    stopping = asyncio.ensure_future(stop_event.wait())
+    while True:
+        fetching = asyncio.ensure_future(bot.get_updates(offset=offset, timeout=DISPATCHER_POLL_TIMEOUT, allowed_updates=Update.ALL_TYPES))
+        await asyncio.wait((fetching, stopping), return_when=asyncio.FIRST_COMPLETED)
+        if not fetching.done():
+            fetching.cancel()
+            break
+        try:
+            updates = fetching.result()
+        except Exception as e:
+            logger.error(f"Ошибка получения апдейтов, повтор через 1 с.: {e}")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            offset = update.update_id + 1
+            dispatch(update, update.to_dict())
+    if offset is not None:
+        # Подтверждаем уже разложенные апдейты, иначе после перезапуска Telegram пришлёт их снова
+        await bot.get_updates(offset=offset, timeout=0)
+
+def workers_readiness_endpoint(processes):
+    def check(request):
+        alive = sum(process.is_alive() for process in processes)
+        ready = alive == len(processes)
+        if not ready:
+            request.set_status(503)
+        request.write({"ready": ready, "workers": len(processes), "workers_alive": alive})
+    return check
+
+async def run_dispatcher() -> None:
+    import multiprocessing
+    from telegram import Bot, Update
+    mp_context = multiprocessing.get_context('spawn')
+    queues = [mp_context.Queue() for _ in range(BOT_WORKERS)]
+
+    def start_worker(index):
+        process = mp_context.Process(target=worker_main, args=(index, queues), name=f"bot-worker-{index}", daemon=True)
+        process.start()
+        return process
+
+    processes = [start_worker(index) for index in range(BOT_WORKERS)]
+    stop_event = _stop_event()
+
+    def dispatch(update, data):
+        queues[_shard_of(update)].put(('update', data))
+
+    async def supervise():
+        while True:
+            await asyncio.sleep(DISPATCHER_SUPERVISE_INTERVAL)
+            for index, process in enumerate(processes):
+                if not process.is_alive():
+                    logger.error(f"Процесс-обработчик {index} завершился с кодом {process.exitcode}, перезапускаю.")
+                    processes[index] = start_worker(index)
+
+    supervisor = asyncio.create_task(supervise())
+    logger.info(f"Диспетчер запустил {BOT_WORKERS} процессов-обработчиков, бэкенд кэша: {CACHE_BACKEND}.")
+    async with Bot(BOT_TOKEN) as bot:
+        if BOT_MODE == 'webhook':
+            async def submit(data):
+                dispatch(Update.de_json(data, bot), data)
+
+            server = make_http_server([
+                (WEBHOOK_PATH, {"post": webhook_endpoint(submit)}),
+                (r"/healthz", {"get": health_endpoint}),
+                (r"/readyz", {"get": workers_readiness_endpoint(processes)}),
+            ])
+            await _set_webhook(bot)
+            server.listen(WEBHOOK_PORT, WEBHOOK_LISTEN)
+            logger.info(f"Webhook-сервер слушает {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+            await stop_event.wait()
+            server.stop()
+        else:
+            await bot.delete_webhook()
+            await _poll_updates(bot, dispatch, stop_event)
+    supervisor.cancel()
+    for worker_queue in queues:
+        worker_queue.put(None)
+    for process in processes:
+        process.join()
+
+# --- БЛОК 17: ОСНОВНАЯ ФУНКЦИЯ ЗАПУСКА И РЕГИСТРАЦИЯ КОМАНД ---
+background_tasks = set()
+cache_warmup_task = None
+
+def _spawn_background(coroutine):
+    task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def cancel_background_tasks():
+    # Монитор лага крутится бесконечно, а прогрев может не успеть до остановки:
+    # отменяем их и дожидаемся завершения до закрытия пула соединений
+    tasks = list(background_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+async def warm_up_caches() -> None:
+    # Справочник (а с ним роли и известные регистрации), заблокировавшие бота и снимки статистики грузятся параллельно,
+    # пока бот уже принимает апдейты: до прогрева обработчики просто идут в БД напрямую
+    started_at = time.perf_counter()
+    loaders = [directory.refresh(), broadcast_store.call(broadcast_store.load_blocked)]
+    if loads_stats_snapshots():
+        loaders += [tmday_snapshot.refresh(), tmmonth_snapshot.refresh()]
+    results = await asyncio.gather(*loaders, return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error(f"Ошибка прогрева кэшей: {result}")
+    logger.info(f"Кэши прогреты за {time.perf_counter() - started_at:.2f} с.")
+
+async def on_stop(application: Application) -> None:
+    await stop_broadcasts()
+    await cancel_background_tasks()
+    # Регистрации, не успевшие уйти по расписанию, записываем до закрытия пула соединений
+    await flush_registrations_job(None)
+
+async def on_startup(application: Application) -> None:
+    global cache_warmup_task
+    init_db_client()
+    _spawn_background(monitor_event_loop_lag())
+    cache_warmup_task = _spawn_background(warm_up_caches())
+    # /metrics слушает только отдельный внутренний порт, а не публичный порт webhook:
+    # у процесса N это METRICS_PORT + N
+    if METRICS_PORT:
+        make_http_server([(r"/metrics", {"get": metrics_endpoint})]).listen(METRICS_PORT + WORKER_INDEX)
+
+def check_config() -> None:
+    if not BOT_TOKEN or not SUPABASE_URL or not SUPABASE_KEY:
+        logger.error("КРИТИЧЕСКАЯ ОШИБКА: Ключи доступа не найдены! Укажите их в переменных окружения.")
+        exit()
+    if BOT_MODE == 'webhook' and (not WEBHOOK_URL or not WEBHOOK_SECRET):
+        logger.error("КРИТИЧЕСКАЯ ОШИБКА: Для режима webhook укажите WEBHOOK_URL и WEBHOOK_SECRET в переменных окружения.")
+        exit()
+    if CACHE_BACKEND not in ('memory', 'redis'):
+        logger.error(f"КРИТИЧЕСКАЯ ОШИБКА: Неизвестный CACHE_BACKEND '{CACHE_BACKEND}', допустимо: memory, redis.")
+        exit()
+    if CACHE_BACKEND == 'redis' and importlib.util.find_spec('redis') is None:
+        logger.error("КРИТИЧЕСКАЯ ОШИБКА: Для CACHE_BACKEND=redis установите пакет redis (pip install redis).")
+        exit()
+
+def build_application() -> Application:
+    from telegram.ext import Application, CallbackQueryHandler, CommandHandler
+    # concurrent_updates: пока один апдейт ждёт ответа Supabase, остальные обрабатываются
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(BOT_CONCURRENT_UPDATES)
+        .connection_pool_size(BOT_CONNECTION_POOL_SIZE)
+        .pool_timeout(BOT_POOL_TIMEOUT)
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(db_close)
+    )
+    if BOT_WORKERS > 1:
+        # Апдейты процессу-обработчику приносит диспетчер, собственный Updater не нужен
+        builder.updater(None)
+    application = builder.build()
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CallbackQueryHandler(button_callback))
@@ -413,9 +2066,43 @@ def main() -> None:
     application.add_handler(CommandHandler("broadcast_team", broadcast_team))
     application.add_handler(CommandHandler("broadcast_city", broadcast_city))
     application.add_handler(CommandHandler("broadcast_dolg", broadcast_dolg))
+    application.add_handler(CommandHandler("broadcast_filter", broadcast_filter))
+    application.add_handler(CommandHandler("broadcast_status", broadcast_status))
+    application.add_handler(CommandHandler("broadcast_cancel", broadcast_cancel))
+    application.add_handler(CommandHandler("prune_blocked", prune_blocked))
+    application.add_handler(CommandHandler("reload_urls", reload_urls_command))
+    application.add_handler(CommandHandler("perf", perf))
+    application.add_handler(CommandHandler("latency", latency))
+    application.add_handler(CommandHandler("cache_reset", cache_reset))
 
+    instrument_application(application)
+
+    # Первую загрузку делает warm_up_caches() из post_init, задачи только поддерживают свежесть
+    application.job_queue.run_repeating(refresh_directory_job, interval=DIRECTORY_REFRESH_INTERVAL, first=DIRECTORY_REFRESH_INTERVAL)
+    if loads_stats_snapshots():
+        application.job_queue.run_repeating(refresh_stats_snapshots_job, interval=STATS_SNAPSHOT_INTERVAL, first=STATS_SNAPSHOT_INTERVAL)
+    application.job_queue.run_repeating(flush_registrations_job, interval=REGISTRATION_FLUSH_INTERVAL)
+    # Все рассылки идут в процессе 0, поэтому после его перезапуска в SQLite нет чужих
+    # незавершённых задач и их можно продолжать без риска отправить сообщения дважды
+    if WORKER_INDEX == 0:
+        application.job_queue.run_once(resume_broadcasts_job, when=0)
+    if MENU_CONFIG_PATH:
+        application.job_queue.run_repeating(watch_menu_config_job, interval=MENU_CONFIG_CHECK_INTERVAL, first=0)
+
+    return application
+
+def main() -> None:
+    check_config()
     print("Бот успешно запущен...")
-    application.run_polling()
+    if BOT_WORKERS > 1:
+        asyncio.run(run_dispatcher())
+        return
+    application = build_application()
+    if BOT_MODE == 'webhook':
+        asyncio.run(run_webhook(application))
+    else:
+        from telegram import Update
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == "__main__":
     main()